@@ -1,15 +1,48 @@
 import argparse
+import time
 
 from llm.gemini_client import (
     augment_resuts_by_llm,
     summarize_results_by_llm,
     enhance_results_by_citations,
-    question_answering_by_llm
+    question_answering_by_llm,
+    augment_results_stream_by_llm,
+    summarize_results_stream_by_llm,
+    enhance_results_by_citations_stream,
+    question_answering_stream_by_llm,
+    gateway,
+    response_cache
 )
+from llm.gateway import format_summary
 from search.hybrid_search import HybridSearch
 from search.data_processing import data_read
 
 
+def print_generation(heading: str, query: str, search_results: list[dict], generate, generate_stream, stream: bool) -> None:
+    if not stream:
+        result = generate(query, search_results)
+
+    print("Search Results:")
+    for element in search_results:
+        print(f"   - {element["document"]["title"]}")
+
+    print(f"\n{heading}:")
+    if not stream:
+        print(result)
+        return
+
+    start = time.perf_counter()
+    first_token = None
+    for text in generate_stream(query, search_results):
+        if first_token is None:
+            first_token = time.perf_counter() - start
+        print(text, end="", flush=True)
+    total = time.perf_counter() - start
+
+    print()
+    if first_token is not None:
+        print(f"\nTime to first token: {first_token * 1000:.0f} ms, Total: {total * 1000:.0f} ms")
+
 def main():
     parser = argparse.ArgumentParser(description="Retrieval Augmented Generation CLI")
     subparsers = parser.add_subparsers(dest="command", help="Available commands")
@@ -18,18 +51,29 @@ def main():
         "rag", help="Perform RAG (search + generate answer)"
     )
     rag_parser.add_argument("query", type=str, help="Search query for RAG")
+    rag_parser.add_argument("--stream", action="store_true", help="Print the LLM answer as it is generated")
+    rag_parser.add_argument("--llm-metrics", action="store_true", help="Print LLM latency and token usage")
 
     llm_summariser_parser = subparsers.add_parser("summarize", help="Summarize the search response by LLM")
     llm_summariser_parser.add_argument("query", type=str, help="Search query")
     llm_summariser_parser.add_argument("--limit", type=int, nargs="?", default=5, help="Default limit is 5")
+    llm_summariser_parser.add_argument("--stream", action="store_true", help="Print the LLM answer as it is generated")
+    llm_summariser_parser.add_argument("--llm-metrics", action="store_true", help="Print LLM latency and token usage")
 
     citation_enhancement_parser = subparsers.add_parser("citations", help="Add citation to the search response")
     citation_enhancement_parser.add_argument("query", type=str, help="Search query")
     citation_enhancement_parser.add_argument("--limit", type=int, nargs="?", default=5, help="Default limit is 5")
+    citation_enhancement_parser.add_argument("--stream", action="store_true", help="Print the LLM answer as it is generated")
+    citation_enhancement_parser.add_argument("--llm-metrics", action="store_true", help="Print LLM latency and token usage")
 
     question_answering_parser = subparsers.add_parser("question", help="Perform QA (search + answer question)")
     question_answering_parser.add_argument("question", type=str, help="Question to ask")
     question_answering_parser.add_argument("--limit", type=int, nargs="?", default=5, help="Default limit is 5")
+    question_answering_parser.add_argument("--stream", action="store_true", help="Print the LLM answer as it is generated")
+    question_answering_parser.add_argument("--llm-metrics", action="store_true", help="Print LLM latency and token usage")
+
+    llm_cache_parser = subparsers.add_parser("llm_cache", help="Show the LLM response cache statistics")
+    llm_cache_parser.add_argument("--clear", action="store_true", help="Remove every cached response")
 
     args = parser.parse_args()
 
@@ -43,14 +87,7 @@ def main():
             hybrid_search = HybridSearch(data["movies"])
 
             search_results = hybrid_search.rrf_search(query, k, limit)
-            augmented_result = augment_resuts_by_llm(query, search_results)
-
-            print("Search Results:")
-            for element in search_results:
-                print(f"   - {element["document"]["title"]}")
-
-            print("\nRAG Response:")
-            print(augmented_result)
+            print_generation("RAG Response", query, search_results, augment_resuts_by_llm, augment_results_stream_by_llm, args.stream)
 
         case "summarize":
             query = args.query
@@ -61,14 +98,7 @@ def main():
             hybrid_search = HybridSearch(data["movies"])
 
             search_results = hybrid_search.rrf_search(query, k, limit)
-            summary_result = summarize_results_by_llm(query, search_results)
-
-            print("Search Results:")
-            for element in search_results:
-                print(f"   - {element["document"]["title"]}")
-
-            print("\nLLM Summary:")
-            print(summary_result)
+            print_generation("LLM Summary", query, search_results, summarize_results_by_llm, summarize_results_stream_by_llm, args.stream)
 
         case "citations":
             query = args.query
@@ -79,14 +109,7 @@ def main():
             hybrid_search = HybridSearch(data["movies"])
 
             search_results = hybrid_search.rrf_search(query, k, limit)
-            citation_result = enhance_results_by_citations(query, search_results)
-
-            print("Search Results:")
-            for element in search_results:
-                print(f"   - {element["document"]["title"]}")
-
-            print("\nLLM Answer:")
-            print(citation_result)
+            print_generation("LLM Answer", query, search_results, enhance_results_by_citations, enhance_results_by_citations_stream, args.stream)
 
         case "question":
             question = args.question
@@ -97,18 +120,31 @@ def main():
             hybrid_search = HybridSearch(data["movies"])
 
             search_results = hybrid_search.rrf_search(question, k, limit)
-            answer = question_answering_by_llm(question, search_results)
+            print_generation("Answer", question, search_results, question_answering_by_llm, question_answering_stream_by_llm, args.stream)
+
+        case "llm_cache":
+            if response_cache is None:
+                print("LLM response cache is disabled (LLM_CACHE=off)")
+                return
 
-            print("Search Results:")
-            for element in search_results:
-                print(f"   - {element["document"]["title"]}")
+            if args.clear:
+                response_cache.clear()
+                print(f"Cleared {response_cache.path}")
 
-            print("\nAnswer:")
-            print(answer)
+            stats = response_cache.stats()
+            print(f"Cache: {response_cache.path}")
+            print(f"Entries: {stats['entries']} ({stats['bytes'] / 1024:.1f} KiB)")
+            print(f"Hits: {stats['total_hits']}, Misses: {stats['total_misses']}, Hit rate: {stats['total_hit_rate']:.1%}")
 
         case _:
             parser.print_help()
 
+    # only the generating commands take --llm-metrics
+    if getattr(args, "llm_metrics", False):
+        print("\nLLM Metrics:")
+        for line in format_summary(gateway.summary()):
+            print(f"   {line}")
+
 
 if __name__ == "__main__":
     main()
\ No newline at end of file
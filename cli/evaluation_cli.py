@@ -1,6 +1,7 @@
 import argparse
+import time
 
-from search.hybrid_search import HybridSearch
+from search.hybrid_search import HybridSearch, multiplier
 from search.utils import data_read
 
 def extract_retrieved_titles(results: list[dict]) -> list[str]:
@@ -15,6 +16,40 @@ def calc_recall(retrieved_titles: list[str], relevant_titles: list[str]) -> floa
 def calc_f1_score(precision_score: float, recall_score: float) -> float:
     return 2 * (precision_score * recall_score) / (precision_score + recall_score)
 
+def mean_recall(results: list[list[dict]], test_cases: list[dict], limit: int) -> float:
+    recalls = [
+        calc_recall(extract_retrieved_titles(retrieved_docs[:limit]), test_case.get("relevant_docs"))
+        for test_case, retrieved_docs in zip(test_cases, results)
+    ]
+    return sum(recalls) / len(recalls)
+
+def top_k_overlap(results: list[list[dict]], reference: list[list[dict]], limit: int) -> float:
+    overlaps = [
+        len(set(extract_retrieved_titles(retrieved_docs[:limit])) & set(extract_retrieved_titles(reference_docs[:limit]))) / max(len(reference_docs[:limit]), 1)
+        for retrieved_docs, reference_docs in zip(results, reference)
+    ]
+    return sum(overlaps) / len(overlaps)
+
+def timed_rrf_search(hybrid_search: HybridSearch, queries: list[str], rrf_k: int, limit: int, **kwargs):
+    started = time.perf_counter()
+    results = [hybrid_search.rrf_search(query, rrf_k, limit, **kwargs) for query in queries]
+    return results, (time.perf_counter() - started) / len(queries)
+
+def depth_sweep(hybrid_search: HybridSearch, test_cases: list[dict], rrf_k: int, limit: int, depths: list[int], adaptive: bool) -> None:
+    queries = [test_case.get("query") for test_case in test_cases]
+    # warm the query embedding cache so every run measures retrieval and fusion only
+    hybrid_search.semantic_search.generate_embeddings(queries)
+
+    reference, reference_latency = timed_rrf_search(hybrid_search, queries, rrf_k, limit)
+    runs = [(f"{depth}", *timed_rrf_search(hybrid_search, queries, rrf_k, limit, bm25_depth=depth, semantic_depth=depth)) for depth in depths]
+    if adaptive:
+        runs.append(("adaptive", *timed_rrf_search(hybrid_search, queries, rrf_k, limit, adaptive=True)))
+    runs.append((f"{limit * multiplier} (default)", reference, reference_latency))
+
+    print(f"{'Depth':>16} {'Recall@' + str(limit):>10} {'Overlap':>8} {'ms/query':>9}")
+    for name, results, latency in runs:
+        print(f"{name:>16} {mean_recall(results, test_cases, limit):>10.4f} {top_k_overlap(results, reference, limit):>8.4f} {latency * 1000:>9.2f}")
+
 def main():
     parser = argparse.ArgumentParser(description="Search Evaluation CLI")
     parser.add_argument(
@@ -23,6 +58,17 @@ def main():
         default=5,
         help="Number of results to evaluate (k for precision@k, recall@k)",
     )
+    parser.add_argument(
+        "--depths",
+        type=int,
+        nargs="+",
+        help="Candidate depths per retriever to compare against the default depth",
+    )
+    parser.add_argument(
+        "--adaptive",
+        action="store_true",
+        help="Use adaptive candidate depth (included as its own row with --depths)",
+    )
 
     args = parser.parse_args()
     limit = args.limit
@@ -32,10 +78,16 @@ def main():
     hybrid_search = HybridSearch(movie_data["movies"])
 
     eval_data = data_read("data/golden_dataset.json")
-    for test_case in eval_data["test_cases"]:
+    if args.depths:
+        depth_sweep(hybrid_search, eval_data["test_cases"], rrf_k, limit, args.depths, args.adaptive)
+        return
+
+    queries = [test_case.get("query") for test_case in eval_data["test_cases"]]
+    results = hybrid_search.rrf_search_many(queries, rrf_k, limit, adaptive=args.adaptive)
+
+    for test_case, retrieved_docs in zip(eval_data["test_cases"], results):
         query = test_case.get("query")
         relevant_docs = test_case.get("relevant_docs")
-        retrieved_docs = hybrid_search.rrf_search(query, rrf_k, limit)
         retrieved_titles = extract_retrieved_titles(retrieved_docs[:limit])
         precision = calc_precision(retrieved_titles, relevant_docs)
         recall = calc_recall(retrieved_titles, relevant_docs)
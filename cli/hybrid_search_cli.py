@@ -1,17 +1,26 @@
 import argparse
-from time import sleep
 
-from search.reranking import cross_encoder_rerank
+from search.reranking import get_reranker
 from search.utils import data_read, debug_rrf
+from search.fusion import NORMALIZATIONS
 from search.hybrid_search import HybridSearch, min_max_normalize
+from llm.rerank_executor import RerankExecutor
 from llm.gemini_client import (
     query_spell_check_by_llm,
     query_rewrite_by_llm,
     query_expand_by_llm,
-    calculate_rerank_score_by_llm,
     calculate_rerank_relevance_by_llm,
-    evaluate_results_by_llm
+    evaluate_results_by_llm,
+    gateway
 )
+from llm.gateway import format_summary
+
+def print_timings(timings: dict) -> None:
+    print(
+        f"Retrieval: BM25 {timings['bm25'] * 1000:.1f} ms, "
+        f"Semantic {timings['semantic'] * 1000:.1f} ms, "
+        f"Total {timings['total'] * 1000:.1f} ms\n"
+    )
 
 def main() -> None:
     parser = argparse.ArgumentParser(description="Hybrid Search CLI")
@@ -24,6 +33,11 @@ def main() -> None:
     weighted_search_parser.add_argument("query", type=str, help="Search query")
     weighted_search_parser.add_argument("--alpha", type=float, nargs="?", default=0.5, help="Weightening factor for keyword/semantic search results")
     weighted_search_parser.add_argument("--limit", type=int, nargs="?", default=5, help="Default limit is 5")
+    weighted_search_parser.add_argument("--timings", action="store_true", help="Print per-retriever timings")
+    weighted_search_parser.add_argument("--bm25-depth", type=int, help="Number of BM25 candidates to fuse (default: limit * 500)")
+    weighted_search_parser.add_argument("--semantic-depth", type=int, help="Number of semantic candidates to fuse (default: limit * 500)")
+    weighted_search_parser.add_argument("--adaptive", action="store_true", help="Grow the candidate depth until the fused top results are stable")
+    weighted_search_parser.add_argument("--normalization", type=str, choices=NORMALIZATIONS, default="min_max", help="Score normalization applied before weighting")
 
     rrf_search_parser = subparsers.add_parser("rrf-search", help="RRF Hybrid Search")
     rrf_search_parser.add_argument("query", type=str, help="Search query")
@@ -32,6 +46,15 @@ def main() -> None:
     rrf_search_parser.add_argument("--enhance", type=str, choices=["spell", "rewrite", "expand"], help="Query enhancement method")
     rrf_search_parser.add_argument("--rerank-method", type=str, choices=["individual", "batch", "cross_encoder"], help="Reranking method for adjusting the results by LLM")
     rrf_search_parser.add_argument("--evaluate", type=bool, nargs="?", default=False, help="Evaluate the reranking results by LLM")
+    rrf_search_parser.add_argument("--timings", action="store_true", help="Print per-retriever timings")
+    rrf_search_parser.add_argument("--llm-metrics", action="store_true", help="Print LLM latency and token usage")
+    rrf_search_parser.add_argument("--rerank-rps", type=float, nargs="?", default=2.0, help="Requests per second allowed for individual LLM reranking")
+    rrf_search_parser.add_argument("--rerank-concurrency", type=int, nargs="?", default=4, help="Concurrent requests for individual LLM reranking")
+    rrf_search_parser.add_argument("--rerank-timeout", type=float, nargs="?", help="Deadline in seconds for each individual LLM rerank request, retries included (default: LLM_DEADLINE)")
+    rrf_search_parser.add_argument("--rerank-batch-size", type=int, nargs="?", default=32, help="Number of (query, document) pairs scored per cross encoder batch")
+    rrf_search_parser.add_argument("--bm25-depth", type=int, help="Number of BM25 candidates to fuse (default: limit * 500)")
+    rrf_search_parser.add_argument("--semantic-depth", type=int, help="Number of semantic candidates to fuse (default: limit * 500)")
+    rrf_search_parser.add_argument("--adaptive", action="store_true", help="Grow the candidate depth until the fused top results are stable")
 
     args = parser.parse_args()
 
@@ -50,7 +73,9 @@ def main() -> None:
             data = data_read("data/movies.json")
             hybrid_search = HybridSearch(data["movies"])
 
-            results = hybrid_search.weighted_search(query, alpha, limit)
+            results = hybrid_search.weighted_search(query, alpha, limit, args.bm25_depth, args.semantic_depth, args.adaptive, args.normalization)
+            if args.timings:
+                print_timings(hybrid_search.timings)
 
             for index, result in enumerate(results, start=1):
                 print(f"{index}. ${result["document"]["title"]}")
@@ -87,22 +112,25 @@ def main() -> None:
             data = data_read("data/movies.json")
             hybrid_search = HybridSearch(data["movies"])
 
-            original_results = hybrid_search.rrf_search(query, k, limit)
+            original_results = hybrid_search.rrf_search(query, k, limit, args.bm25_depth, args.semantic_depth, args.adaptive)
             results = original_results
+            if args.timings:
+                print_timings(hybrid_search.timings)
 
             if rerank_method == "individual":
-                for result in results:
-                    result["rerank_score"] = calculate_rerank_score_by_llm(query, result["document"])
-                    sleep(3)
-                results = sorted(results, key=lambda x: x["rerank_score"], reverse=True)
+                executor = RerankExecutor(requests_per_second=args.rerank_rps, max_concurrency=args.rerank_concurrency, timeout=args.rerank_timeout)
+                scores = executor.rerank(query, [result["document"] for result in results])
+                for result, score in zip(results, scores):
+                    result["rerank_score"] = score
+                results = sorted(results, key=lambda x: x["rerank_score"] if x["rerank_score"] is not None else float("-inf"), reverse=True)
             elif rerank_method == "batch":
                 rerank_ids = calculate_rerank_relevance_by_llm(query, results)
                 for result in results:
                     result["rerank_rank"] = rerank_ids.index(result["document"]["id"]) + 1 if result["document"]["id"] in rerank_ids else 0
                 results = sorted(results, key=lambda x: x["rerank_rank"], reverse=False)
             elif rerank_method == "cross_encoder":
-                pairs = [[query, f"{result['document'].get("title", "")} - {result['document']}"] for result in results]
-                scores = cross_encoder_rerank(pairs)
+                reranker = get_reranker(batch_size=args.rerank_batch_size)
+                scores = reranker.scores(query, [result["document"] for result in results])
                 for result, score in zip(results, scores):
                     result["cross_encoder_score"] = score
                 results = sorted(results, key=lambda x: x["cross_encoder_score"], reverse=True)
@@ -129,6 +157,11 @@ def main() -> None:
             for index, element in enumerate(zip(results, evaluation_results), start=1):
                 print(f"{index}. {element[0]["document"]["title"]}: {element[1]}/3")
 
+            if args.llm_metrics:
+                print("\nLLM Metrics:")
+                for line in format_summary(gateway.summary()):
+                    print(f"   {line}")
+
         case _:
             parser.print_help()
 
@@ -1,8 +1,10 @@
 import argparse
+import os
 import sys
 
 from nltk.stem import PorterStemmer
-from search.inverted_index import InvertedIndex
+from search.ingestion import iter_documents
+from search.inverted_index import InvertedIndex, format_bm25_search
 from search.data_processing import (
     data_read, stopwords_read, DataPreprocessor, BM25_K1, BM25_B
 )
@@ -21,7 +23,15 @@ def main() -> None:
     search_parser = subparsers.add_parser("search", help="Search movies using BM25")
     search_parser.add_argument("query", type=str, help="Search query")
 
-    subparsers.add_parser("build", help="Extract data from input file to the internal cache")
+    build_parser = subparsers.add_parser("build", help="Extract data from input file to the internal cache")
+    build_parser.add_argument("--workers", type=int, nargs="?", default=os.cpu_count() or 1, help="Number of processes used to preprocess the movies")
+    build_parser.add_argument("--shard-size", type=int, nargs="?", default=1000, help="Number of movies handed to a worker at once")
+    build_parser.add_argument("--source", type=str, nargs="?", default="data/movies.json", help="Movies file, a JSON document with a 'movies' array or JSON Lines")
+
+    subparsers.add_parser("convert", help="Convert a pickled index cache to the compact index format")
+
+    apply_delta_parser = subparsers.add_parser("apply-delta", help="Apply added, updated and deleted movies to the cached index")
+    apply_delta_parser.add_argument("delta_file", type=str, help="JSON file with an 'upsert' list of movies and a 'delete' list of movie ids")
 
     term_frequency_parser = subparsers.add_parser("tf", help="Find a term frequency for a document id")
     term_frequency_parser.add_argument("doc_id", type=int, help="Provide a document id to find a term frequency")
@@ -57,9 +67,31 @@ def main() -> None:
 
     match args.command:
         case "build":
-            data = data_read("data/movies.json")
-            inverted_index.build(data["movies"])
+            inverted_index.build(iter_documents(args.source), args.workers, args.shard_size)
+            inverted_index.save()
+
+            stats = inverted_index.build_stats
+            print(f"Indexed {stats['documents']} documents in {stats['seconds']:.2f}s with {stats['workers']} workers ({stats['docs_per_second']:.0f} docs/sec)")
+
+            cache_info = data_preprocessor.stem_cache_info()
+            if cache_info["hits"] + cache_info["misses"] > 0:
+                print(f"Stem cache: {cache_info['hits']} hits, {cache_info['misses']} misses ({cache_info['hit_rate']:.1%} hit rate)")
+
+        case "convert":
+            try:
+                inverted_index.convert_legacy_cache()
+            except FileNotFoundError as error:
+                print(error)
+                sys.exit(1)
+            print(f"Converted {len(inverted_index.docmap)} documents to {inverted_index.index_path}")
+
+        case "apply-delta":
+            load_data(inverted_index)
+
+            delta = data_read(args.delta_file)
+            upserted, removed = inverted_index.apply_delta(delta)
             inverted_index.save()
+            print(f"Upserted {upserted} and removed {removed} documents, index now has {len(inverted_index.docmap)} documents")
 
         case "search":
             load_data(inverted_index)
@@ -67,8 +99,8 @@ def main() -> None:
             search_query = args.query
             results = []
             for search_phrase in search_query.split():
-                documents = inverted_index.index.get(data_preprocessor.transform(search_phrase), set())
-                results.extend(list(documents))
+                documents = inverted_index.get_documents(data_preprocessor.transform(search_phrase))
+                results.extend(documents)
                 results = sorted(list(set(results)))
 
                 if len(results) > 5:
@@ -128,8 +160,8 @@ def main() -> None:
             limit = args.limit
 
             result = inverted_index.bm25_search(query, limit)
-            for element in result:
-                print(element)
+            for index, element in enumerate(result, start=1):
+                print(format_bm25_search(index, element, inverted_index.docmap[element[0]]))
 
         case _:
             parser.print_help()
@@ -0,0 +1,67 @@
+import random
+import threading
+import time
+from types import SimpleNamespace
+
+class FakeModels:
+    def __init__(self, respond, latency: float, failure_rate: float, seed: int, chunk_latency: float):
+        self.respond = respond
+        self.latency = latency
+        self.chunk_latency = chunk_latency
+        self.failure_rate = failure_rate
+        self.random = random.Random(seed)
+        self.lock = threading.Lock()
+        self.calls = 0
+        self.active = 0
+        self.max_active = 0
+
+    def generate_content(self, model: str, contents, config=None):
+        return self.__respond(model, contents, self.__timeout(config))
+
+    def generate_content_stream(self, model: str, contents, config=None):
+        timeout = self.__timeout(config)
+        response = self.__respond(model, contents, timeout)
+        words = response.text.split(" ")
+        for index, word in enumerate(words):
+            if index:
+                self.__wait(self.chunk_latency, timeout)
+            last = index == len(words) - 1
+            yield SimpleNamespace(text=word if last else f"{word} ", usage_metadata=response.usage_metadata if last else None)
+
+    @staticmethod
+    def __timeout(config) -> float | None:
+        # http_options.timeout is in milliseconds, as in genai
+        timeout = ((config or {}).get("http_options") or {}).get("timeout")
+        return timeout / 1000 if timeout else None
+
+    @staticmethod
+    def __wait(seconds: float, timeout: float | None) -> None:
+        if timeout is not None and seconds > timeout:
+            time.sleep(timeout)
+            raise TimeoutError("fake client: simulated transport timeout")
+        time.sleep(seconds)
+
+    def __respond(self, model: str, contents, timeout: float = None):
+        with self.lock:
+            self.calls += 1
+            self.active += 1
+            self.max_active = max(self.max_active, self.active)
+            failed = self.random.random() < self.failure_rate
+
+        try:
+            self.__wait(self.latency, timeout)
+            if failed:
+                raise ConnectionError("fake client: simulated transient failure")
+            text = self.respond(model, contents)
+            return SimpleNamespace(text=text, usage_metadata=SimpleNamespace(prompt_token_count=len(str(contents)) // 4, candidates_token_count=len(text) // 4))
+        finally:
+            with self.lock:
+                self.active -= 1
+
+class FakeClient:
+    # Stands in for genai.Client: same models.generate_content call, canned
+    # responses, configurable latency and a share of calls that fail. Streams
+    # yield the response word by word, chunk_latency apart. A request timeout
+    # passed in the config is honoured the way the real transport does.
+    def __init__(self, respond=None, latency: float = 0.0, failure_rate: float = 0.0, seed: int = 0, chunk_latency: float = 0.0):
+        self.models = FakeModels(respond or (lambda model, contents: "5"), latency, failure_rate, seed, chunk_latency)
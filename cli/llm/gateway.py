@@ -0,0 +1,333 @@
+import math
+import random
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from types import SimpleNamespace
+
+from .fake_client import FakeClient
+
+DEFAULT_MODEL = "gemini-2.0-flash-001"
+DEFAULT_DEADLINE = 60.0
+# longest silence between two chunks once a stream has started
+DEFAULT_IDLE_TIMEOUT = 30.0
+CALL_WORKERS = 8
+# upper bounds in seconds, anything slower lands in the overflow bucket
+LATENCY_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+RETRYABLE_STATUS_CODES = (408, 429, 500, 502, 503, 504)
+
+def close_stream(chunks, pending=None) -> None:
+    # a chunk still being fetched on the pool keeps the generator running, so
+    # it is closed once that fetch completes
+    if pending is not None:
+        pending.add_done_callback(lambda _: close_stream(chunks))
+        return
+
+    close = getattr(chunks, "close", None)
+    if close is not None:
+        close()
+
+def stub_response(model: str, contents) -> str:
+    prompt = " ".join(str(part) for part in contents) if isinstance(contents, list) else str(contents)
+    return f"[{model} stub] {' '.join(prompt.split())[:200]}"
+
+def request_config(timeout: float | None) -> dict:
+    # the transport enforces the timeout, in milliseconds, so a call past its
+    # deadline is ended instead of being left running in the background
+    if timeout is None:
+        return {}
+    return {"config": {"http_options": {"timeout": max(1, math.ceil(timeout * 1000))}}}
+
+class ClientBackend:
+    name = "gemini"
+
+    def __init__(self, client, timeout_errors: tuple = ()):
+        # one client per backend, so its HTTP connection pool is reused across calls
+        self.client = client
+        # the transport's own timeout exceptions, reported as TimeoutError
+        self.timeout_errors = timeout_errors
+
+    def generate(self, model: str, contents, timeout: float = None):
+        try:
+            return self.client.models.generate_content(model=model, contents=contents, **request_config(timeout))
+        except self.timeout_errors as error:
+            raise TimeoutError(f"{model} did not answer within {timeout}s") from error
+
+    def generate_stream(self, model: str, contents, timeout: float = None):
+        try:
+            yield from self.client.models.generate_content_stream(model=model, contents=contents, **request_config(timeout))
+        except self.timeout_errors as error:
+            raise TimeoutError(f"{model} sent nothing within {timeout}s") from error
+
+class StubBackend(ClientBackend):
+    name = "stub"
+
+    def __init__(self, respond=None, latency: float = 0.0, failure_rate: float = 0.0, chunk_latency: float = 0.0):
+        super().__init__(FakeClient(respond or stub_response, latency, failure_rate, chunk_latency=chunk_latency))
+
+class RetryPolicy:
+    def __init__(self, max_retries: int = 3, backoff_base: float = 0.5, backoff_max: float = 8.0):
+        self.max_retries = max_retries
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self.random = random.Random()
+
+    def retryable(self, error: Exception) -> bool:
+        if isinstance(error, (TimeoutError, ConnectionError)):
+            return True
+        return getattr(error, "code", None) in RETRYABLE_STATUS_CODES
+
+    def delay(self, attempt: int) -> float:
+        return self.random.uniform(0, min(self.backoff_max, self.backoff_base * 2 ** attempt))
+
+class OperationMetrics:
+    def __init__(self):
+        self.calls = 0
+        self.cache_hits = 0
+        self.errors = 0
+        self.retries = 0
+        self.timeouts = 0
+        self.prompt_tokens = 0
+        self.response_tokens = 0
+        self.total_tokens = 0
+        self.latency_total = 0.0
+        self.latency_counts = [0] * (len(LATENCY_BUCKETS) + 1)
+        self.first_token_counts = [0] * (len(LATENCY_BUCKETS) + 1)
+
+    def observe(self, latency: float) -> None:
+        self.latency_total += latency
+        self.latency_counts[sum(latency > bound for bound in LATENCY_BUCKETS)] += 1
+
+    def observe_first_token(self, latency: float) -> None:
+        self.first_token_counts[sum(latency > bound for bound in LATENCY_BUCKETS)] += 1
+
+    @staticmethod
+    def percentile(counts: list[int], fraction: float) -> float:
+        # reported as the upper bound of the bucket holding the percentile
+        observed = sum(counts)
+        if not observed:
+            return 0.0
+
+        seen = 0
+        for bound, count in zip((*LATENCY_BUCKETS, float("inf")), counts):
+            seen += count
+            if seen >= fraction * observed:
+                return bound
+        return float("inf")
+
+    def summary(self) -> dict:
+        observed = sum(self.latency_counts)
+        return {
+            "calls": self.calls,
+            "cache_hits": self.cache_hits,
+            "errors": self.errors,
+            "retries": self.retries,
+            "timeouts": self.timeouts,
+            "prompt_tokens": self.prompt_tokens,
+            "response_tokens": self.response_tokens,
+            "total_tokens": self.total_tokens,
+            "mean_latency": self.latency_total / observed if observed else 0.0,
+            "p50_latency": self.percentile(self.latency_counts, 0.5),
+            "p95_latency": self.percentile(self.latency_counts, 0.95),
+            "streams": sum(self.first_token_counts),
+            "p50_first_token": self.percentile(self.first_token_counts, 0.5),
+            "p95_first_token": self.percentile(self.first_token_counts, 0.95),
+            "histogram": dict(zip((*LATENCY_BUCKETS, float("inf")), self.latency_counts)),
+        }
+
+class LLMGateway:
+    def __init__(self, backend, model: str = DEFAULT_MODEL, cache=None, deadline: float | None = DEFAULT_DEADLINE, retry_policy: RetryPolicy = None, workers: int = CALL_WORKERS, idle_timeout: float | None = DEFAULT_IDLE_TIMEOUT):
+        self.backend = backend
+        self.model = model
+        self.cache = cache
+        self.deadline = deadline
+        self.idle_timeout = idle_timeout
+        self.retry_policy = retry_policy or RetryPolicy()
+        self.metrics = {}
+        self.lock = threading.Lock()
+        # request deadlines are enforced by the transport; the pool only waits out
+        # the idle timeout between stream chunks, and a chunk read abandoned there
+        # still ends once the transport times out
+        self.calls = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="llm-gateway")
+
+    def generate(self, contents, operation: str = "generate_content", model: str = None, backend=None, throttle=None, deadline: float = None):
+        # throttle, when given, is called before every backend attempt, retries
+        # included, so a caller's rate limit also holds while the backend is failing
+        model = model or self.model
+        # responses from an injected backend (e.g. a fake in tests) never touch the shared cache
+        cache = self.cache if backend is None else None
+        backend = backend or self.backend
+
+        key = cache.key(model, contents, {"backend": backend.name}) if cache is not None else None
+        if cache is not None and (cached := cache.get(key)) is not None:
+            self.__update(operation, cache_hits=1)
+            return cached
+
+        if throttle is not None:
+            throttle()
+        start = time.perf_counter()
+        seconds = deadline if deadline is not None else self.deadline
+        deadline = start + seconds if seconds is not None else None
+        attempt = 0
+        while True:
+            try:
+                if attempt and throttle is not None:
+                    throttle()
+                result = self.__call(backend, model, contents, deadline)
+                break
+            except Exception as error:
+                timed_out = isinstance(error, TimeoutError)
+                delay = self.retry_policy.delay(attempt)
+                if (
+                    attempt >= self.retry_policy.max_retries
+                    or not self.retry_policy.retryable(error)
+                    or (deadline is not None and time.perf_counter() + delay >= deadline)
+                ):
+                    self.__update(operation, calls=1, errors=1, timeouts=int(timed_out), latency=time.perf_counter() - start)
+                    raise
+
+                self.__update(operation, retries=1, timeouts=int(timed_out))
+                time.sleep(delay)
+                attempt += 1
+
+        usage = getattr(result, "usage_metadata", None)
+        self.__update(
+            operation,
+            calls=1,
+            prompt_tokens=getattr(usage, "prompt_token_count", None) or 0,
+            response_tokens=getattr(usage, "candidates_token_count", None) or 0,
+            total_tokens=getattr(usage, "total_token_count", None) or 0,
+            latency=time.perf_counter() - start,
+        )
+        if cache is not None:
+            cache.put(key, model, result)
+        return result
+
+    def stream(self, contents, operation: str = "generate_content", model: str = None, backend=None):
+        model = model or self.model
+        cache = self.cache if backend is None else None
+        backend = backend or self.backend
+
+        key = cache.key(model, contents, {"backend": backend.name}) if cache is not None else None
+        if cache is not None and (cached := cache.get(key)) is not None:
+            self.__update(operation, cache_hits=1)
+            yield cached.text
+            return
+
+        # The request deadline bounds the wait for the first chunk, retries included.
+        # After that each chunk only has to arrive within idle_timeout of the
+        # previous one, so a long answer is not cut off halfway through. Only the
+        # first chunk is retried: once text has reached the caller a failure can
+        # no longer be hidden.
+        start = time.perf_counter()
+        deadline = start + self.deadline if self.deadline is not None else None
+        attempt = 0
+        while True:
+            chunks = None
+            try:
+                chunks = iter(backend.generate_stream(model, contents, self.__remaining(deadline, model)))
+                chunk = next(chunks, None)
+                break
+            except Exception as error:
+                timed_out = isinstance(error, TimeoutError)
+                if chunks is not None:
+                    close_stream(chunks)
+                delay = self.retry_policy.delay(attempt)
+                if (
+                    attempt >= self.retry_policy.max_retries
+                    or not self.retry_policy.retryable(error)
+                    or (deadline is not None and time.perf_counter() + delay >= deadline)
+                ):
+                    self.__update(operation, calls=1, errors=1, timeouts=int(timed_out), latency=time.perf_counter() - start)
+                    raise
+
+                self.__update(operation, retries=1, timeouts=int(timed_out))
+                time.sleep(delay)
+                attempt += 1
+
+        first_token = None
+        texts = []
+        usage = None
+        abandoned = False
+        try:
+            while chunk is not None:
+                usage = getattr(chunk, "usage_metadata", None) or usage
+                if chunk.text:
+                    if first_token is None:
+                        first_token = time.perf_counter() - start
+                    texts.append(chunk.text)
+                    yield chunk.text
+                chunk = self.__next(chunks, self.idle_timeout, f"{model} sent nothing for {self.idle_timeout}s")
+        except Exception as error:
+            abandoned = isinstance(error, TimeoutError)
+            self.__update(operation, calls=1, errors=1, timeouts=int(abandoned), latency=time.perf_counter() - start)
+            raise
+        finally:
+            # also runs when the caller stops reading early (GeneratorExit)
+            if not abandoned:
+                close_stream(chunks)
+
+        self.__update(
+            operation,
+            calls=1,
+            prompt_tokens=getattr(usage, "prompt_token_count", None) or 0,
+            response_tokens=getattr(usage, "candidates_token_count", None) or 0,
+            total_tokens=getattr(usage, "total_token_count", None) or 0,
+            latency=time.perf_counter() - start,
+            first_token=first_token,
+        )
+        if cache is not None:
+            cache.put(key, model, SimpleNamespace(text="".join(texts), usage_metadata=usage))
+
+    def summary(self) -> dict:
+        with self.lock:
+            return {operation: metrics.summary() for operation, metrics in self.metrics.items()}
+
+    def close(self) -> None:
+        self.calls.shutdown(wait=False, cancel_futures=True)
+
+    def __call(self, backend, model: str, contents, deadline: float | None):
+        return backend.generate(model, contents, self.__remaining(deadline, model))
+
+    def __remaining(self, deadline: float | None, model: str) -> float | None:
+        if deadline is None:
+            return None
+
+        remaining = deadline - time.perf_counter()
+        if remaining <= 0:
+            raise TimeoutError(f"{model} did not answer before the request deadline")
+        return remaining
+
+    def __next(self, chunks, timeout: float | None, message: str):
+        if timeout is None:
+            return next(chunks, None)
+
+        future = self.calls.submit(next, chunks, None)
+        try:
+            return future.result(timeout=timeout)
+        except TimeoutError:
+            future.cancel()
+            close_stream(chunks, future)
+            raise TimeoutError(message)
+
+    def __update(self, operation: str, latency: float = None, first_token: float = None, **counters: int) -> None:
+        with self.lock:
+            metrics = self.metrics.setdefault(operation, OperationMetrics())
+            for name, value in counters.items():
+                setattr(metrics, name, getattr(metrics, name) + value)
+            if latency is not None:
+                metrics.observe(latency)
+            if first_token is not None:
+                metrics.observe_first_token(first_token)
+
+def format_summary(summary: dict) -> list[str]:
+    lines = []
+    for operation, metrics in summary.items():
+        lines.append(
+            f"{operation}: {metrics['calls']} calls, {metrics['cache_hits']} cached, "
+            f"{metrics['retries']} retries, {metrics['errors']} errors, "
+            f"p50 <= {metrics['p50_latency'] * 1000:.0f} ms, p95 <= {metrics['p95_latency'] * 1000:.0f} ms, "
+            f"tokens {metrics['prompt_tokens']} in / {metrics['response_tokens']} out"
+            + (f", first token p50 <= {metrics['p50_first_token'] * 1000:.0f} ms" if metrics["streams"] else "")
+        )
+    return lines
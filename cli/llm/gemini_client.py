@@ -1,14 +1,54 @@
 import json
 import os
 
+import httpx
 from dotenv import load_dotenv
 from google import genai
 from google.genai import types
 
+from .gateway import DEFAULT_DEADLINE, DEFAULT_IDLE_TIMEOUT, DEFAULT_MODEL, ClientBackend, LLMGateway, RetryPolicy, StubBackend
+from .response_cache import CACHE_MAX_BYTES, CACHE_PATH, CACHE_TTL, ResponseCache
+
 load_dotenv()
 api_key = os.environ.get("GEMINI_API_KEY")
 
-client = genai.Client(api_key=api_key)
+response_cache = ResponseCache(
+    os.environ.get("LLM_CACHE_PATH", CACHE_PATH),
+    ttl=float(os.environ.get("LLM_CACHE_TTL", CACHE_TTL)),
+    max_bytes=int(os.environ.get("LLM_CACHE_MAX_BYTES", CACHE_MAX_BYTES))
+) if os.environ.get("LLM_CACHE", "on") != "off" else None
+
+request_deadline = float(os.environ.get("LLM_DEADLINE", DEFAULT_DEADLINE))
+
+match os.environ.get("LLM_BACKEND", "gemini"):
+    case "stub":
+        backend = StubBackend(
+            latency=float(os.environ.get("LLM_STUB_LATENCY", 0.0)),
+            chunk_latency=float(os.environ.get("LLM_STUB_CHUNK_LATENCY", 0.0))
+        )
+    case "gemini":
+        backend = ClientBackend(
+            genai.Client(api_key=api_key, http_options=types.HttpOptions(timeout=int(request_deadline * 1000))),
+            timeout_errors=(httpx.TimeoutException,)
+        )
+    case name:
+        raise ValueError(f"Unknown LLM_BACKEND '{name}', expected 'gemini' or 'stub'")
+
+gateway = LLMGateway(
+    backend,
+    model=os.environ.get("LLM_MODEL", DEFAULT_MODEL),
+    cache=response_cache,
+    deadline=request_deadline,
+    retry_policy=RetryPolicy(max_retries=int(os.environ.get("LLM_MAX_RETRIES", 3))),
+    idle_timeout=float(os.environ.get("LLM_IDLE_TIMEOUT", DEFAULT_IDLE_TIMEOUT))
+)
+
+def generate_content(contents, operation: str, llm_client: genai.Client = None, throttle=None, deadline: float = None):
+    client_backend = ClientBackend(llm_client, timeout_errors=(httpx.TimeoutException,)) if llm_client is not None else None
+    return gateway.generate(contents, operation, backend=client_backend, throttle=throttle, deadline=deadline)
+
+def generate_content_stream(contents, operation: str):
+    return gateway.stream(contents, operation)
 
 def is_float(value: str) -> bool:
     try:
@@ -216,44 +256,38 @@ Given the included image and text query, rewrite the text query to improve searc
     )
 
 def query_spell_check_by_llm(query: str):
-    model = "gemini-2.0-flash-001"
     prompt = [spell_check_prompt(query)]
 
-    result = client.models.generate_content(model=model, contents=prompt)
+    result = generate_content(prompt, "query_spell_check")
     return result.text
 
 def query_rewrite_by_llm(query: str):
-    model = "gemini-2.0-flash-001"
     prompt = [rewrite_query_prompt(query)]
 
-    result = client.models.generate_content(model=model, contents=prompt)
+    result = generate_content(prompt, "query_rewrite")
     return result.text
 
 def query_expand_by_llm(query: str):
-    model = "gemini-2.0-flash-001"
     prompt = [expand_query_prompt(query)]
 
-    result = client.models.generate_content(model=model, contents=prompt)
+    result = generate_content(prompt, "query_expand")
     return result.text
 
-def calculate_rerank_score_by_llm(query: str, doc: dict):
-    model = "gemini-2.0-flash-001"
+def calculate_rerank_score_by_llm(query: str, doc: dict, llm_client: genai.Client = None, throttle=None, deadline: float = None):
     prompt = [rerank_basic_prompt(query, doc)]
 
-    result = client.models.generate_content(model=model, contents=prompt)
+    result = generate_content(prompt, "calculate_rerank_score", llm_client, throttle, deadline)
     return float(result.text) if is_float(result.text) else None
 
 def calculate_rerank_relevance_by_llm(query: str, docs: list[str]):
-    model = "gemini-2.0-flash-001"
     doc_list_str = ", ".join(list(map(lambda x: json.dumps(x["document"]), docs)))
 
     prompt = [rerank_batch_prompt(query, doc_list_str)]
-    result = client.models.generate_content(model=model, contents=prompt)
+    result = generate_content(prompt, "calculate_rerank_relevance")
 
     return json.loads(result.text[7:-3]) or []
 
 def evaluate_results_by_llm(query: str, results: list[dict]):
-    model = "gemini-2.0-flash-001"
     formatted_results = list(
         map(
             lambda x:
@@ -264,74 +298,62 @@ def evaluate_results_by_llm(query: str, results: list[dict]):
     )
 
     prompt = [evaluation_batch_prompt(query, formatted_results)]
-    result = client.models.generate_content(model=model, contents=prompt)
+    result = generate_content(prompt, "evaluate_results")
 
     return json.loads(result.text) or []
 
-def augment_resuts_by_llm(query: str, docs: list[dict]):
-    model = "gemini-2.0-flash-001"
-    data = list(
-        map(
-            lambda x: {
-                "title": x["document"]["title"],
-                "description": x["document"]["description"]},
-            docs)
-    )
-    prompt = [augmented_generation_prompt(query, data)]
-    result = client.models.generate_content(model=model, contents=prompt)
+def prompt_documents(docs: list[dict]) -> list[dict]:
+    return [{"title": doc["document"]["title"], "description": doc["document"]["description"]} for doc in docs]
+
+# The blocking and streaming helpers share one builder per prompt, so both
+# variants send the same contents and hit the same response cache entries.
+def augment_results_contents(query: str, docs: list[dict]) -> list:
+    return [augmented_generation_prompt(query, prompt_documents(docs))]
+
+def summarize_results_contents(query: str, docs: list[dict]) -> list:
+    return [summarize_results_prompt(query, prompt_documents(docs))]
+
+def citation_contents(query: str, docs: list[dict]) -> list:
+    return [citation_adding_prompt(query, prompt_documents(docs))]
+
+def question_answering_contents(query: str, docs: list[dict]) -> list:
+    return [question_answering_prompt(query, docs)]
 
+def augment_resuts_by_llm(query: str, docs: list[dict]):
+    result = generate_content(augment_results_contents(query, docs), "augment_results")
     return result.text
 
 def summarize_results_by_llm(query: str, docs: list[dict]):
-    model = "gemini-2.0-flash-001"
-    data = list(
-        map(
-            lambda x: {
-                "title": x["document"]["title"],
-                "description": x["document"]["description"]},
-            docs)
-    )
-    prompt = [summarize_results_prompt(query, data)]
-    result = client.models.generate_content(model=model, contents=prompt)
-
+    result = generate_content(summarize_results_contents(query, docs), "summarize_results")
     return result.text
 
 def enhance_results_by_citations(query: str, docs: list[dict]):
-    model = "gemini-2.0-flash-001"
-    data = list(
-        map(
-            lambda x: {
-                "title": x["document"]["title"],
-                "description": x["document"]["description"]},
-            docs)
-    )
-    prompt = [citation_adding_prompt(query, data)]
-    result = client.models.generate_content(model=model, contents=prompt)
-
+    result = generate_content(citation_contents(query, docs), "enhance_results_by_citations")
     return result.text
 
 def question_answering_by_llm(query: str, docs: list[dict]):
-    model = "gemini-2.0-flash-001"
-    data = list(
-        map(
-            lambda x: {
-                "title": x["document"]["title"],
-                "description": x["document"]["description"]},
-            docs)
-    )
-    prompt = [question_answering_prompt(query, docs)]
-    result = client.models.generate_content(model=model, contents=prompt)
-
+    result = generate_content(question_answering_contents(query, docs), "question_answering")
     return result.text
 
+def augment_results_stream_by_llm(query: str, docs: list[dict]):
+    return generate_content_stream(augment_results_contents(query, docs), "augment_results")
+
+def summarize_results_stream_by_llm(query: str, docs: list[dict]):
+    return generate_content_stream(summarize_results_contents(query, docs), "summarize_results")
+
+def enhance_results_by_citations_stream(query: str, docs: list[dict]):
+    return generate_content_stream(citation_contents(query, docs), "enhance_results_by_citations")
+
+def question_answering_stream_by_llm(query: str, docs: list[dict]):
+    return generate_content_stream(question_answering_contents(query, docs), "question_answering")
+
 def multimodal_llm_query(query: str, image: bytes, mime: str):
-    model = "gemini-2.0-flash-001"
     system_prompt = multimodal_basic_prompt()
     parts = [
         system_prompt,
         types.Part.from_bytes(data=image, mime_type=mime),
         query.strip()
     ]
-    result = client.models.generate_content(model=model, contents=parts)
+    result = generate_content(parts, "multimodal_llm_query")
 
     return result.text.strip(), result.usage_metadata
\ No newline at end of file
@@ -0,0 +1,76 @@
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from .gemini_client import calculate_rerank_score_by_llm
+
+REQUESTS_PER_SECOND = 2.0
+BURST = 5
+MAX_CONCURRENCY = 4
+
+class TokenBucket:
+    def __init__(self, rate: float, capacity: int, clock=time.monotonic, sleep=time.sleep):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = float(capacity)
+        self.clock = clock
+        self.sleep = sleep
+        self.updated = clock()
+        self.lock = threading.Lock()
+
+    def acquire(self) -> float:
+        waited = 0.0
+        while True:
+            with self.lock:
+                now = self.clock()
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return waited
+                delay = (1 - self.tokens) / self.rate
+            self.sleep(delay)
+            waited += delay
+
+class RerankExecutor:
+    # Retries, backoff and deadlines belong to the LLM gateway. The executor only
+    # bounds concurrency and hands the gateway a throttle that takes one token per
+    # backend attempt, so retried requests are rate limited as well.
+    def __init__(
+        self,
+        score=calculate_rerank_score_by_llm,
+        llm_client=None,
+        requests_per_second: float = REQUESTS_PER_SECOND,
+        burst: int = BURST,
+        max_concurrency: int = MAX_CONCURRENCY,
+        timeout: float = None,
+        sleep=time.sleep,
+    ):
+        self.score = score
+        self.llm_client = llm_client
+        self.bucket = TokenBucket(requests_per_second, burst, sleep=sleep)
+        self.max_concurrency = max_concurrency
+        self.timeout = timeout
+        self.lock = threading.Lock()
+        self.stats = {"documents": 0, "requests": 0, "failures": 0, "throttled_seconds": 0.0}
+
+    def __record(self, name: str, value=1) -> None:
+        with self.lock:
+            self.stats[name] += value
+
+    def throttle(self) -> None:
+        self.__record("throttled_seconds", self.bucket.acquire())
+        self.__record("requests")
+
+    def score_document(self, query: str, document: dict):
+        self.__record("documents")
+        try:
+            return self.score(query, document, self.llm_client, throttle=self.throttle, deadline=self.timeout)
+        except Exception:
+            # whatever was retryable has already been retried by the gateway
+            self.__record("failures")
+            return None
+
+    def rerank(self, query: str, documents: list[dict]) -> list:
+        with ThreadPoolExecutor(max_workers=self.max_concurrency, thread_name_prefix="rerank") as executor:
+            return list(executor.map(lambda document: self.score_document(query, document), documents))
@@ -0,0 +1,153 @@
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+from types import SimpleNamespace
+
+CACHE_PATH = "cache/llm_responses.sqlite3"
+CACHE_TTL = 7 * 24 * 3600
+CACHE_MAX_BYTES = 64 * 1024 * 1024
+
+def encode_value(value):
+    # images and other binary parts are addressed by their digest, not their bytes
+    if isinstance(value, (bytes, bytearray)):
+        return {"sha256": hashlib.sha256(value).hexdigest()}
+    if hasattr(value, "model_dump"):
+        return value.model_dump(exclude_none=True)
+    return str(value)
+
+def usage_dict(usage) -> dict | None:
+    if usage is None:
+        return None
+    if hasattr(usage, "model_dump"):
+        return usage.model_dump(exclude_none=True)
+    return {name: value for name, value in vars(usage).items() if value is not None}
+
+class ResponseCache:
+    def __init__(self, path: str = CACHE_PATH, ttl: float = CACHE_TTL, max_bytes: int = CACHE_MAX_BYTES):
+        self.path = path
+        self.ttl = ttl
+        self.max_bytes = max_bytes
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.connection = None
+
+    @staticmethod
+    def key(model: str, contents, parameters: dict = None) -> str:
+        payload = json.dumps(
+            {"model": model, "contents": contents, "parameters": parameters or {}},
+            sort_keys=True, default=encode_value, ensure_ascii=False
+        )
+        return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+    def connect(self) -> sqlite3.Connection:
+        if self.connection is None:
+            os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+            # WAL lets several CLI processes read while one of them writes
+            self.connection = sqlite3.connect(self.path, timeout=30, check_same_thread=False, isolation_level=None)
+            self.connection.execute("PRAGMA journal_mode=WAL")
+            self.connection.execute(
+                "CREATE TABLE IF NOT EXISTS responses ("
+                "key TEXT PRIMARY KEY, model TEXT, text TEXT, usage TEXT, size INTEGER, created REAL, accessed REAL)"
+            )
+            self.connection.execute("CREATE INDEX IF NOT EXISTS responses_accessed ON responses (accessed)")
+            self.connection.execute("CREATE TABLE IF NOT EXISTS counters (name TEXT PRIMARY KEY, value INTEGER)")
+        return self.connection
+
+    def get(self, key: str):
+        now = time.time()
+        with self.lock:
+            connection = self.connect()
+            row = connection.execute("SELECT text, usage, created FROM responses WHERE key = ?", (key,)).fetchone()
+            if row is not None and now - row[2] > self.ttl:
+                connection.execute("DELETE FROM responses WHERE key = ?", (key,))
+                row = None
+
+            if row is None:
+                self.misses += 1
+                self.__count("misses")
+                return None
+
+            connection.execute("UPDATE responses SET accessed = ? WHERE key = ?", (now, key))
+            self.hits += 1
+            self.__count("hits")
+
+        text, usage, _ = row
+        usage = json.loads(usage) if usage else None
+        return SimpleNamespace(text=text, usage_metadata=SimpleNamespace(**usage) if usage is not None else None, cached=True)
+
+    def put(self, key: str, model: str, response) -> None:
+        text = response.text
+        if text is None:
+            return
+
+        usage = usage_dict(getattr(response, "usage_metadata", None))
+        usage = json.dumps(usage) if usage is not None else None
+        size = len(text.encode("utf-8")) + len(usage or "")
+        now = time.time()
+        with self.lock:
+            connection = self.connect()
+            connection.execute(
+                "INSERT OR REPLACE INTO responses (key, model, text, usage, size, created, accessed) VALUES (?, ?, ?, ?, ?, ?, ?)",
+                (key, model, text, usage, size, now, now)
+            )
+            self.__evict(now)
+
+    def stats(self) -> dict:
+        with self.lock:
+            connection = self.connect()
+            entries, size = connection.execute("SELECT COUNT(*), COALESCE(SUM(size), 0) FROM responses").fetchone()
+            counters = dict(connection.execute("SELECT name, value FROM counters").fetchall())
+
+        lookups = self.hits + self.misses
+        total_hits, total_misses = counters.get("hits", 0), counters.get("misses", 0)
+        total_lookups = total_hits + total_misses
+        return {
+            "entries": entries,
+            "bytes": size,
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / lookups if lookups else 0.0,
+            "total_hits": total_hits,
+            "total_misses": total_misses,
+            "total_hit_rate": total_hits / total_lookups if total_lookups else 0.0,
+        }
+
+    def clear(self) -> None:
+        with self.lock:
+            connection = self.connect()
+            connection.execute("DELETE FROM responses")
+            connection.execute("DELETE FROM counters")
+
+    def close(self) -> None:
+        with self.lock:
+            if self.connection is not None:
+                self.connection.close()
+                self.connection = None
+
+    def __count(self, name: str) -> None:
+        self.connection.execute(
+            "INSERT INTO counters (name, value) VALUES (?, 1) ON CONFLICT(name) DO UPDATE SET value = value + 1", (name,)
+        )
+
+    def __evict(self, now: float) -> None:
+        self.connection.execute("DELETE FROM responses WHERE created < ?", (now - self.ttl,))
+        size = self.connection.execute("SELECT COALESCE(SUM(size), 0) FROM responses").fetchone()[0]
+        if size <= self.max_bytes:
+            return
+
+        # least recently used entries go first until the store fits again
+        self.connection.execute("BEGIN IMMEDIATE")
+        try:
+            for key, entry_size in self.connection.execute("SELECT key, size FROM responses ORDER BY accessed").fetchall():
+                if size <= self.max_bytes:
+                    break
+                self.connection.execute("DELETE FROM responses WHERE key = ?", (key,))
+                size -= entry_size
+            self.connection.execute("COMMIT")
+        except BaseException:
+            self.connection.execute("ROLLBACK")
+            raise
@@ -4,116 +4,421 @@ import os
 import numpy as np
 
 from .chunking import semantic_chunking
-from .semantic_search import SemanticSearch, cosine_similarity
+from .ingestion import DOCUMENT_BATCH_SIZE, IngestCheckpoint, batched
+from .ivf_index import DEFAULT_NPROBE, IVFIndex
+from .manifest import content_hash, create_manifest, is_compatible, manifest_path, read_manifest, remove_manifest, write_manifest
+from .semantic_search import SemanticSearch
+from .vector_index import VectorIndex, normalize_rows, normalize_vector, save_array, top_k
 
 cache_dir = './cache'
 db_file = 'chunk_embeddings.npy'
-metadata_json = 'chunk_metadata.json'
+metadata_file = 'chunk_metadata.npz'
+legacy_metadata_json = 'chunk_metadata.json'
 
 SCORE_PRECISION = 4
 
+CHUNK_SIZE = 4
+CHUNK_OVERLAP = 1
+
+AGGREGATIONS = ("max", "mean", "sum")
+
+def validate_aggregation(method: str, top_n: int) -> None:
+    if method not in AGGREGATIONS:
+        raise ValueError(f"Unknown aggregation '{method}', expected one of {AGGREGATIONS}")
+    if top_n < 1:
+        raise ValueError(f"top_n must be at least 1, got {top_n}")
+
+def chunk_entry(document: dict) -> tuple[int, str]:
+    return document.get("id"), content_hash(document.get("description") or "")
+
+class ChunkMetadata:
+    def __init__(self, movie_idx, chunk_idx, total_chunks):
+        self.movie_idx = np.asarray(movie_idx, dtype=np.int32)
+        self.chunk_idx = np.asarray(chunk_idx, dtype=np.int32)
+        self.total_chunks = np.asarray(total_chunks, dtype=np.int32)
+
+        # Chunks are grouped per movie so that a per-movie reduction is a single
+        # reduceat call. Rows are normally written movie by movie already, the
+        # permutation is only kept when they are not.
+        if np.all(self.movie_idx[1:] >= self.movie_idx[:-1]):
+            self.order = None
+            sorted_movies = self.movie_idx
+        else:
+            self.order = np.argsort(self.movie_idx, kind="stable")
+            sorted_movies = self.movie_idx[self.order]
+
+        if len(sorted_movies) == 0:
+            self.group_starts = np.empty(0, dtype=np.intp)
+        else:
+            self.group_starts = np.flatnonzero(np.r_[True, sorted_movies[1:] != sorted_movies[:-1]])
+
+        self.group_movies = sorted_movies[self.group_starts]
+        self.group_sizes = np.diff(np.r_[self.group_starts, len(sorted_movies)])
+        self.group_ids = np.repeat(np.arange(len(self.group_starts)), self.group_sizes)
+        self.row_groups = None
+
+    def __len__(self) -> int:
+        return len(self.movie_idx)
+
+    @classmethod
+    def from_records(cls, records: list[dict]) -> "ChunkMetadata":
+        return cls(
+            [record["movie_idx"] for record in records],
+            [record["chunk_idx"] for record in records],
+            [record["total_chunks"] for record in records],
+        )
+
+    @classmethod
+    def load(cls, file_path: str) -> "ChunkMetadata":
+        with np.load(file_path) as data:
+            return cls(data["movie_idx"], data["chunk_idx"], data["total_chunks"])
+
+    def save(self, file_path: str) -> None:
+        temp_path = f"{file_path}.tmp"
+        with open(temp_path, "wb") as file:
+            np.savez(
+                file,
+                movie_idx=self.movie_idx,
+                chunk_idx=self.chunk_idx,
+                total_chunks=self.total_chunks,
+            )
+        os.replace(temp_path, file_path)
+
+    def rows_by_movie(self) -> dict[int, np.ndarray]:
+        rows = self.order if self.order is not None else np.arange(len(self.movie_idx))
+        return {
+            int(movie_idx): rows[start:start + size]
+            for movie_idx, start, size in zip(self.group_movies, self.group_starts, self.group_sizes)
+        }
+
+    def subset(self, rows: np.ndarray) -> "ChunkMetadata":
+        return ChunkMetadata(self.movie_idx[rows], self.chunk_idx[rows], self.total_chunks[rows])
+
+    def movie_rows(self, rows: np.ndarray) -> np.ndarray:
+        # every chunk row of the movies the given rows belong to, grouped by movie
+        if self.row_groups is None:
+            self.row_groups = np.empty(len(self.movie_idx), dtype=np.intp)
+            self.row_groups[self.order if self.order is not None else slice(None)] = self.group_ids
+
+        groups = np.unique(self.row_groups[rows])
+        sizes = self.group_sizes[groups]
+        offsets = np.arange(sizes.sum()) - np.repeat(np.cumsum(sizes) - sizes, sizes)
+        positions = np.repeat(self.group_starts[groups], sizes) + offsets
+        return self.order[positions] if self.order is not None else positions
+
+    def aggregate(self, scores: np.ndarray, method: str = "max", top_n: int = 3):
+        validate_aggregation(method, top_n)
+
+        if len(self.group_starts) == 0:
+            return self.group_movies, np.empty(0, dtype=np.float32), np.empty(0, dtype=np.intp)
+
+        rows = self.order if self.order is not None else np.arange(len(scores))
+        grouped_scores = scores[rows]
+
+        max_scores = np.maximum.reduceat(grouped_scores, self.group_starts)
+
+        if method == "max":
+            movie_scores = max_scores
+        elif method == "sum":
+            movie_scores = np.add.reduceat(grouped_scores, self.group_starts)
+        else:
+            ranked = np.lexsort((-grouped_scores, self.group_ids))
+            ranks = np.arange(len(ranked)) - np.repeat(self.group_starts, self.group_sizes)
+            selected = ranks < top_n
+            movie_scores = np.bincount(
+                self.group_ids[selected],
+                weights=grouped_scores[ranked][selected],
+                minlength=len(self.group_starts)
+            ) / np.minimum(self.group_sizes, top_n)
+
+        winners = np.flatnonzero(grouped_scores == np.repeat(max_scores, self.group_sizes))
+        winner_groups = self.group_ids[winners]
+        first_winners = winners[np.r_[True, winner_groups[1:] != winner_groups[:-1]]]
+
+        return self.group_movies, movie_scores, rows[first_winners]
+
 class ChunkedSemanticSearch(SemanticSearch):
-    def __init__(self, model_name = "all-MiniLM-L6-v2") -> None:
-        super().__init__(model_name)
+    def __init__(self, model_name = "all-MiniLM-L6-v2", mmap: bool = False, storage: str = "float32", query_cache_size: int = 1024, query_cache_path: str = None) -> None:
+        super().__init__(model_name, mmap, storage, query_cache_size, query_cache_path)
         self.chunk_embeddings = None
+        self.chunk_index = None
         self.chunk_metadata = None
+        self.ann_index = None
 
-    def build_chunk_embeddings(self, documents):
-        self.documents = documents
+    def chunk_embeddings_manifest(self, documents: list[dict]) -> dict:
+        return create_manifest(
+            self.model_name,
+            [chunk_entry(document) for document in documents],
+            chunking="semantic",
+            chunk_size=CHUNK_SIZE,
+            chunk_overlap=CHUNK_OVERLAP
+        )
+
+    def save_chunk_embeddings(self, embeddings: np.ndarray, chunk_metadata: ChunkMetadata, documents: list[dict]) -> np.ndarray:
+        remove_manifest(manifest_path(os.path.join(cache_dir, db_file)))
+        save_array(os.path.join(cache_dir, db_file), embeddings)
+        return self.activate_chunk_embeddings(chunk_metadata, self.chunk_embeddings_manifest(documents))
+
+    def activate_chunk_embeddings(self, chunk_metadata: ChunkMetadata, manifest: dict) -> np.ndarray:
+        embeddings_path = os.path.join(cache_dir, db_file)
+        chunk_metadata.save(os.path.join(cache_dir, metadata_file))
+
+        self.chunk_embeddings = np.load(embeddings_path, mmap_mode="r")
+        self.chunk_metadata = chunk_metadata
+        # the rebuild below removes the IVF index trained on the previous rows, it is rebuilt on first use
+        self.ann_index = None
+        self.chunk_index = self.load_or_create_index(self.chunk_embeddings, embeddings_path, rebuild=True)
+        write_manifest(manifest_path(embeddings_path), manifest)
 
-        for document in documents:
-            doc_id = document.get("id")
-            if not doc_id:
-                raise ValueError("Missing 'id' in the document element")
-            self.document_map[doc_id] = document
+        return self.chunk_embeddings
+
+    def ingest_chunk_embeddings(self, documents, batch_size: int = DOCUMENT_BATCH_SIZE, checkpoint_dir: str = None, source: str = None) -> np.ndarray:
+        manifest = self.chunk_embeddings_manifest([])
+        checkpoint = IngestCheckpoint(
+            checkpoint_dir or os.path.join(cache_dir, "ingest_chunks"),
+            {key: value for key, value in manifest.items() if key != "documents"},
+            source
+        )
+
+        document_index = checkpoint.documents
+        for batch in batched(checkpoint.remaining(documents), batch_size):
+            chunks: list[str] = []
+            movie_indices: list[int] = []
+            chunk_indices: list[int] = []
+            total_chunks: list[int] = []
+
+            for document in batch:
+                description = document.get("description")
+                if description:
+                    chunks_elements = semantic_chunking(description, CHUNK_SIZE, CHUNK_OVERLAP)
+                    for chunk_index, chunk_element in enumerate(chunks_elements):
+                        chunks.append(chunk_element)
+                        movie_indices.append(document_index)
+                        chunk_indices.append(chunk_index)
+                        total_chunks.append(len(chunks_elements))
+                document_index += 1
+
+            doc_ids, hashes = zip(*map(chunk_entry, batch))
+            checkpoint.write_part(
+                len(batch),
+                embeddings=self.model.encode(chunks) if chunks else np.empty((0, 0), dtype=np.float32),
+                movie_idx=np.array(movie_indices, dtype=np.int32),
+                chunk_idx=np.array(chunk_indices, dtype=np.int32),
+                total_chunks=np.array(total_chunks, dtype=np.int32),
+                doc_ids=np.array(doc_ids),
+                hashes=np.array(hashes)
+            )
+
+        remove_manifest(manifest_path(os.path.join(cache_dir, db_file)))
+        checkpoint.write_rows("embeddings", os.path.join(cache_dir, db_file))
+        chunk_metadata = ChunkMetadata(
+            checkpoint.concatenate("movie_idx"),
+            checkpoint.concatenate("chunk_idx"),
+            checkpoint.concatenate("total_chunks")
+        )
+        manifest["documents"] = [[int(doc_id), str(digest)] for doc_id, digest in zip(checkpoint.concatenate("doc_ids"), checkpoint.concatenate("hashes"))]
+        embeddings = self.activate_chunk_embeddings(chunk_metadata, manifest)
+        checkpoint.clear()
+        return embeddings
+
+    def build_chunk_embeddings(self, documents):
+        self.register_documents(documents)
 
         chunks: list[str] = []
-        chunks_metadata: list[dict] = []
+        movie_indices: list[int] = []
+        chunk_indices: list[int] = []
+        total_chunks: list[int] = []
 
         for document_index, document in enumerate(documents):
             description = document.get("description")
             if not description:
                 continue
 
-            chunks_elements = semantic_chunking(description, 4, 1)
+            chunks_elements = semantic_chunking(description, CHUNK_SIZE, CHUNK_OVERLAP)
             for chunk_index, chunk_element in enumerate(chunks_elements):
                 chunks.append(chunk_element)
-                metadata = {
-                    "movie_idx": document_index,
-                    "chunk_idx": chunk_index,
-                    "total_chunks": len(chunks_elements)
-                }
-                chunks_metadata.append(metadata)
+                movie_indices.append(document_index)
+                chunk_indices.append(chunk_index)
+                total_chunks.append(len(chunks_elements))
 
-        self.chunk_embeddings = self.model.encode(chunks)
-        self.chunk_metadata = chunks_metadata
+        embeddings = self.model.encode(chunks)
+        return self.save_chunk_embeddings(embeddings, ChunkMetadata(movie_indices, chunk_indices, total_chunks), documents)
 
-        np.save(os.path.join(cache_dir, db_file), self.chunk_embeddings)
+    def update_chunk_embeddings(self, documents: list[dict], manifest: dict):
+        old_embeddings = np.load(os.path.join(cache_dir, db_file), mmap_mode="r")
+        old_metadata = self.load_chunk_metadata()
+        if old_metadata is None or len(old_metadata) != len(old_embeddings):
+            return self.build_chunk_embeddings(documents)
 
-        with open(os.path.join(cache_dir, metadata_json), "w") as file:
-            json.dump({
-                "chunks": chunks_metadata,
-                "total_chunks": len(chunks)
-            }, file, indent=2 )
+        self.register_documents(documents)
+        old_positions = {tuple(entry): index for index, entry in enumerate(manifest["documents"])}
+        old_rows = old_metadata.rows_by_movie()
 
-        return self.chunk_embeddings
+        chunks: list[str] = []
+        pieces: list[tuple[bool, np.ndarray]] = []
+        movie_indices: list[np.ndarray] = []
+        chunk_indices: list[np.ndarray] = []
+        total_chunks: list[np.ndarray] = []
 
-    def load_or_create_chunk_embeddings(self, documents: list[dict]) -> np.ndarray:
-        self.documents = documents
+        for document_index, document in enumerate(documents):
+            description = document.get("description")
+            old_position = old_positions.get((document.get("id"), content_hash(description or "")))
+
+            if old_position is not None:
+                rows = old_rows.get(old_position, np.empty(0, dtype=np.intp))
+                pieces.append((True, rows))
+                chunk_indices.append(old_metadata.chunk_idx[rows])
+                total_chunks.append(old_metadata.total_chunks[rows])
+            elif description:
+                chunks_elements = semantic_chunking(description, CHUNK_SIZE, CHUNK_OVERLAP)
+                rows = np.arange(len(chunks), len(chunks) + len(chunks_elements))
+                chunks.extend(chunks_elements)
+                pieces.append((False, rows))
+                chunk_indices.append(np.arange(len(chunks_elements)))
+                total_chunks.append(np.full(len(chunks_elements), len(chunks_elements)))
+            else:
+                continue
 
-        for document in documents:
-            doc_id = document.get("id")
-            if not doc_id:
-                raise ValueError("Missing 'id' in the document element")
-            self.document_map[doc_id] = document
+            movie_indices.append(np.full(len(rows), document_index))
 
-        if os.path.exists(os.path.join(cache_dir, db_file)) and os.path.exists(os.path.join(cache_dir, metadata_json)):
-            self.chunk_embeddings = np.load(os.path.join(cache_dir, db_file))
+        new_embeddings = self.model.encode(chunks) if chunks else None
 
-            with open(os.path.join(cache_dir, metadata_json), "r") as file:
+        embeddings = np.empty((sum(len(rows) for _, rows in pieces), old_embeddings.shape[1]), dtype=old_embeddings.dtype)
+        position = 0
+        for reused, rows in pieces:
+            embeddings[position:position + len(rows)] = old_embeddings[rows] if reused else new_embeddings[rows]
+            position += len(rows)
+
+        chunk_metadata = ChunkMetadata(
+            np.concatenate(movie_indices or [np.empty(0)]),
+            np.concatenate(chunk_indices or [np.empty(0)]),
+            np.concatenate(total_chunks or [np.empty(0)])
+        )
+        return self.save_chunk_embeddings(embeddings, chunk_metadata, documents)
+
+    def load_chunk_metadata(self) -> ChunkMetadata | None:
+        if os.path.exists(os.path.join(cache_dir, metadata_file)):
+            return ChunkMetadata.load(os.path.join(cache_dir, metadata_file))
+
+        if os.path.exists(os.path.join(cache_dir, legacy_metadata_json)):
+            with open(os.path.join(cache_dir, legacy_metadata_json), "r") as file:
                 data = json.load(file)
-                self.chunk_metadata = data["chunks"]
+            chunk_metadata = ChunkMetadata.from_records(data["chunks"])
+            chunk_metadata.save(os.path.join(cache_dir, metadata_file))
+            return chunk_metadata
+
+        return None
+
+    def load_or_create_chunk_embeddings(self, documents: list[dict]) -> np.ndarray:
+        self.register_documents(documents)
+
+        expected = self.chunk_embeddings_manifest(documents)
+        manifest = read_manifest(manifest_path(os.path.join(cache_dir, db_file)))
+
+        if os.path.exists(os.path.join(cache_dir, db_file)):
+            if manifest == expected:
+                chunk_metadata = self.load_chunk_metadata()
+                if chunk_metadata is not None:
+                    self.chunk_embeddings = np.load(os.path.join(cache_dir, db_file), mmap_mode="r")
+                    self.chunk_index = self.load_or_create_index(self.chunk_embeddings, os.path.join(cache_dir, db_file))
+                    self.chunk_metadata = chunk_metadata
+                    return self.chunk_embeddings
 
-            return self.chunk_embeddings
+            if is_compatible(manifest, expected):
+                return self.update_chunk_embeddings(documents, manifest)
 
         return self.build_chunk_embeddings(documents)
 
-    def search_chunks(self, query: str, limit: int = 10):
+    def load_or_create_ann_index(self, list_count: int = None, rebuild: bool = False) -> IVFIndex:
+        prefix = os.path.splitext(os.path.join(cache_dir, db_file))[0]
+        ann_index = None if rebuild else IVFIndex.load(prefix)
+
+        if ann_index is None or len(ann_index) != len(self.chunk_index) or (list_count and ann_index.list_count != list_count):
+            ann_index = IVFIndex.build(VectorIndex(self.chunk_embeddings), list_count)
+            ann_index.save(prefix)
+
+        self.ann_index = ann_index
+        return ann_index
+
+    def search_chunks(self, query: str, limit: int = 10, aggregation: str = "max", top_n: int = 3, ann: bool = False, nprobe: int = DEFAULT_NPROBE, rescore: int = 0):
+        validate_aggregation(aggregation, top_n)
         query_embeddings = self.generate_embedding(query)
-        chunks_scores = []
-
-        for index, chunk_embedding in enumerate(self.chunk_embeddings):
-            chunk_idx = self.chunk_metadata[index]["chunk_idx"]
-            movie_idx = self.chunk_metadata[index]["movie_idx"]
-            score = cosine_similarity(chunk_embedding, query_embeddings)
-            chunks_scores.append({
-                "chunk_idx": chunk_idx,
-                "movie_idx": movie_idx,
-                "score": score
-            })
-
-        movie_scores = {}
-        for chunks_score in chunks_scores:
-            movie_idx = chunks_score["movie_idx"]
-            movie_score = movie_scores.get(movie_idx)
-            if not movie_score:
-                movie_scores[movie_idx] = chunks_score["score"]
-            else:
-                existing_score = movie_scores[movie_idx]
-                new_score = chunks_score["score"]
-                movie_scores[movie_idx] = new_score if new_score > existing_score else existing_score
+        if ann or rescore:
+            return self.rank_query(query_embeddings, limit, aggregation, top_n, ann, nprobe, rescore)
+
+        chunk_scores = self.chunk_index.score(query_embeddings)
+        return self.rank_chunk_scores(chunk_scores, limit, aggregation, top_n)
 
-        sorted_result = sorted(movie_scores.items(), key=lambda x: x[1], reverse=True)
+    def search_chunks_many(self, queries: list[str], limit: int = 10, aggregation: str = "max", top_n: int = 3, batch_size: int = 64, ann: bool = False, nprobe: int = DEFAULT_NPROBE, rescore: int = 0):
+        validate_aggregation(aggregation, top_n)
         results = []
-        for element in sorted_result[0:limit]:
-            document = self.documents[element[0]]
+        for start in range(0, len(queries), batch_size):
+            query_embeddings = self.generate_embeddings(queries[start:start + batch_size])
+            if ann or rescore:
+                results.extend(
+                    self.rank_query(query_embedding, limit, aggregation, top_n, ann, nprobe, rescore)
+                    for query_embedding in query_embeddings
+                )
+                continue
+
+            for chunk_scores in self.chunk_index.score_many(query_embeddings):
+                results.append(self.rank_chunk_scores(chunk_scores, limit, aggregation, top_n))
+        return results
+
+    def movie_scores_many(self, queries: list[str], aggregation: str = "max", top_n: int = 3, batch_size: int = 64) -> list[tuple[np.ndarray, np.ndarray]]:
+        # aggregated score of every movie per query, so callers can widen their
+        # top-k selection without scoring the chunk matrix again
+        validate_aggregation(aggregation, top_n)
+        doc_ids = np.fromiter((self.documents[movie]["id"] for movie in self.chunk_metadata.group_movies), dtype=np.int64, count=len(self.chunk_metadata.group_movies))
+
+        results = []
+        for start in range(0, len(queries), batch_size):
+            query_embeddings = self.generate_embeddings(queries[start:start + batch_size])
+            for chunk_scores in self.chunk_index.score_many(query_embeddings):
+                _, movie_scores, _ = self.chunk_metadata.aggregate(chunk_scores, aggregation, top_n)
+                results.append((doc_ids, movie_scores))
+        return results
+
+    def rank_query(self, query_embedding: np.ndarray, limit: int, aggregation: str = "max", top_n: int = 3, ann: bool = False, nprobe: int = DEFAULT_NPROBE, rescore: int = 0):
+        # Candidate rows are always widened to every chunk of the nominated movies
+        # so that mean/sum aggregation does not see half a movie.
+        rows = None
+        if ann:
+            if self.ann_index is None:
+                self.load_or_create_ann_index()
+            rows = self.chunk_metadata.movie_rows(self.ann_index.candidates(query_embedding, nprobe))
+            chunk_scores = self.chunk_index.score_rows(query_embedding, rows)
+        else:
+            chunk_scores = self.chunk_index.score(query_embedding)
+
+        if rescore:
+            candidates = top_k(chunk_scores, rescore)
+            rows = self.chunk_metadata.movie_rows(candidates if rows is None else rows[candidates])
+            chunk_scores = normalize_rows(self.chunk_embeddings[rows]) @ normalize_vector(query_embedding)
+
+        chunk_metadata = None if rows is None else self.chunk_metadata.subset(rows)
+        return self.rank_chunk_scores(chunk_scores, limit, aggregation, top_n, chunk_metadata)
+
+    def rank_chunk_scores(self, chunk_scores: np.ndarray, limit: int, aggregation: str = "max", top_n: int = 3, chunk_metadata: ChunkMetadata = None):
+        if chunk_metadata is None:
+            chunk_metadata = self.chunk_metadata
+        movie_indices, movie_scores, best_chunks = chunk_metadata.aggregate(chunk_scores, aggregation, top_n)
+
+        results = []
+        for position in top_k(movie_scores, limit):
+            document = self.documents[movie_indices[position]]
+            best_chunk = best_chunks[position]
             result = {
                 "id": document["id"],
                 "title": document["title"],
                 "document": document["description"][:100],
-                "score": round(element[1], SCORE_PRECISION),
-                "metadata": {}
+                "score": round(float(movie_scores[position]), SCORE_PRECISION),
+                "metadata": {
+                    "chunk_idx": int(chunk_metadata.chunk_idx[best_chunk]),
+                    "total_chunks": int(chunk_metadata.total_chunks[best_chunk]),
+                    "chunk_score": round(float(chunk_scores[best_chunk]), SCORE_PRECISION)
+                }
             }
             results.append(result)
 
-        return results
\ No newline at end of file
+        return results
@@ -0,0 +1,188 @@
+import math
+import os
+import struct
+
+import numpy as np
+
+from .data_processing import BM25_K1, BM25_B
+
+INDEX_MAGIC = b"RAGIDX\x00\x00"
+INDEX_VERSION = 1
+
+# magic, version, flags, doc count, term count, posting count, term blob size, average doc length
+HEADER_FORMAT = "<8sIIQQQQd"
+HEADER_SIZE = 64
+ALIGNMENT = 8
+
+def bm25_tf(term_frequency, doc_length, avg_doc_length: float, k1 = BM25_K1, b = BM25_B):
+    length_norm = 1 - b + b * (doc_length / avg_doc_length)
+    return term_frequency * (k1 + 1) / (term_frequency + k1 * length_norm)
+
+def bm25_idf(doc_count: int, term_doc_count: int) -> float:
+    return math.log((doc_count - term_doc_count + 0.5) / (term_doc_count + 0.5) + 1)
+
+class CompiledIndex:
+
+    def __init__(self, doc_ids: np.ndarray, doc_lengths: np.ndarray, avg_doc_length: float, postings: dict[str, tuple[np.ndarray, np.ndarray]]):
+        self.doc_ids = doc_ids
+        self.doc_lengths = doc_lengths
+        self.avg_doc_length = avg_doc_length
+        self.term_postings = postings
+        self.idf = {term: bm25_idf(len(doc_ids), len(positions)) for term, (positions, _) in postings.items()}
+        self.doc_positions = None
+
+    def terms(self) -> list[str]:
+        return sorted(self.term_postings.keys(), key=lambda term: term.encode("utf-8"))
+
+    def postings(self, term: str) -> tuple[np.ndarray, np.ndarray]:
+        return self.term_postings.get(term, (np.empty(0, dtype=np.int32), np.empty(0, dtype=np.int32)))
+
+    def document_frequency(self, term: str) -> int:
+        return len(self.postings(term)[0])
+
+    def get_idf(self, term: str) -> float:
+        idf = self.idf.get(term)
+        return idf if idf is not None else bm25_idf(len(self.doc_ids), 0)
+
+    def get_tfs(self, term: str, positions: np.ndarray) -> np.ndarray:
+        term_positions, term_frequencies = self.postings(term)
+        if len(term_positions) == 0:
+            return np.zeros(len(positions), dtype=np.int32)
+
+        found = np.minimum(np.searchsorted(term_positions, positions), len(term_positions) - 1)
+        return np.where(term_positions[found] == positions, term_frequencies[found], 0)
+
+    def position(self, doc_id: int) -> int | None:
+        if self.doc_positions is None:
+            self.doc_positions = {int(doc_id): position for position, doc_id in enumerate(self.doc_ids)}
+        return self.doc_positions.get(doc_id)
+
+def aligned(offset: int) -> int:
+    return (offset + ALIGNMENT - 1) // ALIGNMENT * ALIGNMENT
+
+def section_layout(doc_count: int, term_count: int, posting_count: int, term_blob_size: int) -> dict[str, tuple[int, np.dtype, int]]:
+    sections = [
+        ("doc_ids", np.dtype("<i8"), doc_count),
+        ("doc_lengths", np.dtype("<u4"), doc_count),
+        ("term_offsets", np.dtype("<u8"), term_count + 1),
+        ("posting_offsets", np.dtype("<u8"), term_count + 1),
+        ("posting_deltas", np.dtype("<u4"), posting_count),
+        ("posting_tfs", np.dtype("<u4"), posting_count),
+        ("term_blob", np.dtype("u1"), term_blob_size),
+    ]
+
+    layout = {}
+    offset = HEADER_SIZE
+    for name, dtype, count in sections:
+        layout[name] = (offset, dtype, count)
+        offset = aligned(offset + dtype.itemsize * count)
+    return layout
+
+def write_compact_index(file_path: str, compiled: CompiledIndex) -> None:
+    terms = compiled.terms()
+    encoded_terms = [term.encode("utf-8") for term in terms]
+
+    term_offsets = np.zeros(len(terms) + 1, dtype="<u8")
+    term_offsets[1:] = np.cumsum([len(term) for term in encoded_terms])
+    posting_offsets = np.zeros(len(terms) + 1, dtype="<u8")
+    posting_offsets[1:] = np.cumsum([compiled.document_frequency(term) for term in terms])
+
+    posting_count = int(posting_offsets[-1])
+    posting_deltas = np.empty(posting_count, dtype="<u4")
+    posting_tfs = np.empty(posting_count, dtype="<u4")
+    for index, term in enumerate(terms):
+        positions, term_frequencies = compiled.postings(term)
+        start, end = int(posting_offsets[index]), int(posting_offsets[index + 1])
+        posting_deltas[start:end] = np.diff(positions, prepend=0)
+        posting_tfs[start:end] = term_frequencies
+
+    arrays = {
+        "doc_ids": np.asarray(compiled.doc_ids, dtype="<i8"),
+        "doc_lengths": np.asarray(compiled.doc_lengths, dtype="<u4"),
+        "term_offsets": term_offsets,
+        "posting_offsets": posting_offsets,
+        "posting_deltas": posting_deltas,
+        "posting_tfs": posting_tfs,
+        "term_blob": np.frombuffer(b"".join(encoded_terms), dtype="u1"),
+    }
+
+    layout = section_layout(len(compiled.doc_ids), len(terms), posting_count, len(arrays["term_blob"]))
+    header = struct.pack(
+        HEADER_FORMAT, INDEX_MAGIC, INDEX_VERSION, 0,
+        len(compiled.doc_ids), len(terms), posting_count, len(arrays["term_blob"]),
+        compiled.avg_doc_length
+    )
+
+    temp_path = f"{file_path}.tmp"
+    with open(temp_path, "wb") as file:
+        file.write(header.ljust(HEADER_SIZE, b"\x00"))
+        for name, (offset, _, _) in layout.items():
+            file.write(b"\x00" * (offset - file.tell()))
+            file.write(arrays[name].tobytes())
+    os.replace(temp_path, file_path)
+
+class CompactIndex(CompiledIndex):
+
+    def __init__(self, file_path: str):
+        if not os.path.exists(file_path):
+            raise FileNotFoundError(f"{file_path} doesn't exist")
+
+        self.buffer = np.memmap(file_path, dtype=np.uint8, mode="r")
+        magic, version, _, doc_count, term_count, posting_count, term_blob_size, avg_doc_length = struct.unpack_from(HEADER_FORMAT, self.buffer)
+
+        if magic != INDEX_MAGIC:
+            raise ValueError(f"{file_path} is not an inverted index file")
+        if version != INDEX_VERSION:
+            raise ValueError(f"{file_path} has unsupported index version {version}")
+
+        sections = {}
+        for name, (offset, dtype, count) in section_layout(doc_count, term_count, posting_count, term_blob_size).items():
+            sections[name] = self.buffer[offset:offset + dtype.itemsize * count].view(dtype)
+
+        self.doc_ids = sections["doc_ids"]
+        self.doc_lengths = sections["doc_lengths"]
+        self.avg_doc_length = avg_doc_length
+        self.term_offsets = sections["term_offsets"]
+        self.posting_offsets = sections["posting_offsets"]
+        self.posting_deltas = sections["posting_deltas"]
+        self.posting_tfs = sections["posting_tfs"]
+        self.term_blob = sections["term_blob"]
+        self.term_count = term_count
+        self.doc_positions = None
+
+    def term_at(self, index: int) -> bytes:
+        return self.term_blob[self.term_offsets[index]:self.term_offsets[index + 1]].tobytes()
+
+    def find_term(self, term: str) -> int | None:
+        key = term.encode("utf-8")
+        low, high = 0, self.term_count
+        while low < high:
+            middle = (low + high) // 2
+            if self.term_at(middle) < key:
+                low = middle + 1
+            else:
+                high = middle
+        if low < self.term_count and self.term_at(low) == key:
+            return low
+        return None
+
+    def terms(self) -> list[str]:
+        return [self.term_at(index).decode("utf-8") for index in range(self.term_count)]
+
+    def postings(self, term: str) -> tuple[np.ndarray, np.ndarray]:
+        index = self.find_term(term)
+        if index is None:
+            return np.empty(0, dtype=np.int32), np.empty(0, dtype=np.int32)
+
+        start, end = self.posting_offsets[index], self.posting_offsets[index + 1]
+        positions = np.cumsum(self.posting_deltas[start:end], dtype=np.int64)
+        return positions, self.posting_tfs[start:end]
+
+    def document_frequency(self, term: str) -> int:
+        index = self.find_term(term)
+        if index is None:
+            return 0
+        return int(self.posting_offsets[index + 1] - self.posting_offsets[index])
+
+    def get_idf(self, term: str) -> float:
+        return bm25_idf(len(self.doc_ids), self.document_frequency(term))
@@ -1,10 +1,15 @@
 import json
 import string
+from functools import lru_cache
 from nltk.stem import PorterStemmer
 
 BM25_K1 = 1.5
 BM25_B = 0.75
 
+STEM_CACHE_SIZE = 100_000
+
+PUNCTUATION_TABLE = str.maketrans("", "", string.punctuation)
+
 def data_read(file_name: str) -> dict[str, list[dict]]:
     with open(file_name, "r") as file:
         return json.load(file)
@@ -14,9 +19,31 @@ def stopwords_read(file_name: str) -> list[str]:
         return file.read().splitlines()
 
 class DataPreprocessor:
-    def __init__(self, stemmer: PorterStemmer, stopwords: list[str] = None):
+    def __init__(self, stemmer: PorterStemmer, stopwords: list[str] = None, stem_cache_size: int = STEM_CACHE_SIZE):
         self.stopwords = set(stopwords or [])
         self.stemmer = stemmer
+        self.stem_cache_size = stem_cache_size
+        self.stem = lru_cache(maxsize=stem_cache_size)(self.stemmer.stem)
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        del state["stem"]
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.stem = lru_cache(maxsize=self.stem_cache_size)(self.stemmer.stem)
+
+    def stem_cache_info(self) -> dict:
+        info = self.stem.cache_info()
+        lookups = info.hits + info.misses
+        return {
+            "hits": info.hits,
+            "misses": info.misses,
+            "size": info.currsize,
+            "max_size": info.maxsize,
+            "hit_rate": info.hits / lookups if lookups else 0.0,
+        }
 
     @staticmethod
     def lower(phrase: str) -> str:
@@ -28,7 +55,7 @@ class DataPreprocessor:
 
     @staticmethod
     def remove_punctuation(phrase: str) -> str:
-        return phrase.translate(str.maketrans("", "", string.punctuation))
+        return phrase.translate(PUNCTUATION_TABLE)
 
     @staticmethod
     def remove_whitespace(data: list[str]) -> list[str]:
@@ -38,11 +65,8 @@ class DataPreprocessor:
         return " ".join(list(filter(lambda x: x not in self.stopwords, phrase.split())))
 
     def stem_words(self, phrase: str) -> str:
-        return " ".join(list(map(lambda x: self.stemmer.stem(x), phrase.split())))
+        return " ".join(self.stem(token.lower()) for token in phrase.split())
 
     def transform(self, phrase):
-        phrase = self.lower(phrase)
-        phrase = self.remove_punctuation(phrase)
-        phrase = self.remove_stop_words(phrase)
-        phrase = self.stem_words(phrase)
-        return phrase
\ No newline at end of file
+        tokens = phrase.lower().translate(PUNCTUATION_TABLE).split()
+        return " ".join(self.stem(token) for token in tokens if token not in self.stopwords)
\ No newline at end of file
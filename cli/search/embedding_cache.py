@@ -0,0 +1,113 @@
+import os
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+
+import numpy as np
+
+def normalize_query(text: str) -> str:
+    return " ".join(text.split())
+
+class QueryEmbeddingCache:
+    def __init__(self, model_name: str, max_size: int = 1024, cache_path: str = None, max_disk_entries: int = 100_000):
+        self.model_name = model_name
+        self.max_size = max_size
+        self.max_disk_entries = max_disk_entries
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+
+        self.connection = None
+        if cache_path:
+            directory = os.path.dirname(cache_path)
+            if directory:
+                os.makedirs(directory, exist_ok=True)
+            self.connection = sqlite3.connect(cache_path, check_same_thread=False)
+            self.connection.execute(
+                "CREATE TABLE IF NOT EXISTS query_embeddings ("
+                "model TEXT NOT NULL, query TEXT NOT NULL, dtype TEXT NOT NULL, vector BLOB NOT NULL, "
+                "last_used REAL NOT NULL, PRIMARY KEY (model, query))"
+            )
+            self.connection.commit()
+
+    def get(self, text: str) -> np.ndarray | None:
+        with self.lock:
+            embedding = self.entries.get(text)
+            if embedding is not None:
+                self.entries.move_to_end(text)
+                self.hits += 1
+                return embedding
+
+            embedding = self.__read_disk(text)
+            if embedding is not None:
+                self.disk_hits += 1
+                self.__remember(text, embedding)
+                return embedding
+
+            self.misses += 1
+            return None
+
+    def put(self, text: str, embedding: np.ndarray) -> np.ndarray:
+        embedding = np.array(embedding)
+        embedding.setflags(write=False)
+
+        with self.lock:
+            self.__remember(text, embedding)
+            self.__write_disk(text, embedding)
+        return embedding
+
+    def stats(self) -> dict:
+        lookups = self.hits + self.disk_hits + self.misses
+        return {
+            "hits": self.hits,
+            "disk_hits": self.disk_hits,
+            "misses": self.misses,
+            "size": len(self.entries),
+            "max_size": self.max_size,
+            "hit_rate": (self.hits + self.disk_hits) / lookups if lookups else 0.0,
+        }
+
+    def __remember(self, text: str, embedding: np.ndarray) -> None:
+        if self.max_size <= 0:
+            return
+
+        self.entries[text] = embedding
+        self.entries.move_to_end(text)
+        while len(self.entries) > self.max_size:
+            self.entries.popitem(last=False)
+
+    def __read_disk(self, text: str) -> np.ndarray | None:
+        if self.connection is None:
+            return None
+
+        row = self.connection.execute(
+            "SELECT dtype, vector FROM query_embeddings WHERE model = ? AND query = ?",
+            (self.model_name, text)
+        ).fetchone()
+        if row is None:
+            return None
+
+        self.connection.execute(
+            "UPDATE query_embeddings SET last_used = ? WHERE model = ? AND query = ?",
+            (time.time(), self.model_name, text)
+        )
+        self.connection.commit()
+        return np.frombuffer(row[1], dtype=row[0])
+
+    def __write_disk(self, text: str, embedding: np.ndarray) -> None:
+        if self.connection is None:
+            return
+
+        self.connection.execute(
+            "INSERT OR REPLACE INTO query_embeddings (model, query, dtype, vector, last_used) VALUES (?, ?, ?, ?, ?)",
+            (self.model_name, text, embedding.dtype.str, embedding.tobytes(), time.time())
+        )
+        self.connection.execute(
+            "DELETE FROM query_embeddings WHERE rowid IN ("
+            "SELECT rowid FROM query_embeddings ORDER BY last_used DESC LIMIT -1 OFFSET ?)",
+            (self.max_disk_entries,)
+        )
+        self.connection.commit()
@@ -0,0 +1,88 @@
+import numpy as np
+
+from .vector_index import top_k
+
+NORMALIZATIONS = ("min_max", "z_score")
+
+def min_max_scores(scores: np.ndarray) -> np.ndarray:
+    if len(scores) == 0:
+        return scores
+
+    low, high = scores.min(), scores.max()
+    if low == high:
+        return np.ones_like(scores)
+    return (scores - low) / (high - low)
+
+def z_scores(scores: np.ndarray) -> np.ndarray:
+    if len(scores) == 0:
+        return scores
+
+    deviation = scores.std()
+    if deviation == 0:
+        return np.zeros_like(scores)
+    return (scores - scores.mean()) / deviation
+
+def rank_scores(scores: np.ndarray) -> np.ndarray:
+    ranks = np.empty(len(scores), dtype=np.int64)
+    ranks[np.argsort(-scores, kind="stable")] = np.arange(1, len(scores) + 1)
+    return ranks
+
+def rrf_scores(ranks: np.ndarray, k: int = 60) -> np.ndarray:
+    return np.where(ranks > 0, 1 / (k + ranks), 0.0)
+
+def align(candidate_ids: list[np.ndarray]) -> tuple[np.ndarray, list[np.ndarray]]:
+    # Every retriever's candidates get a slot in one dense array. Slots follow the
+    # order in which documents were first seen so ties resolve like the old dicts.
+    if not candidate_ids:
+        return np.empty(0, dtype=np.int64), []
+
+    unique_ids, first_seen = np.unique(np.concatenate(candidate_ids), return_index=True)
+    order = np.argsort(first_seen, kind="stable")
+
+    slots = np.empty(len(unique_ids), dtype=np.intp)
+    slots[order] = np.arange(len(unique_ids))
+    return unique_ids[order], [slots[np.searchsorted(unique_ids, ids)] for ids in candidate_ids]
+
+def weighted_fusion(results: list[tuple[np.ndarray, np.ndarray]], weights: list[float], limit: int, normalization: str = "min_max"):
+    if normalization not in NORMALIZATIONS:
+        raise ValueError(f"Unknown normalization '{normalization}', expected one of {NORMALIZATIONS}")
+    if len(weights) != len(results):
+        raise ValueError("Expected one weight per retriever")
+
+    normalize = min_max_scores if normalization == "min_max" else z_scores
+    doc_ids, slots = align([ids for ids, _ in results])
+
+    # a document a retriever did not return gets that retriever's lowest normalized
+    # score; 0 would be the mean under z-scores and rank it above returned documents
+    normalized = np.zeros((len(results), len(doc_ids)), dtype=np.float64)
+    for row, ((_, scores), slot) in enumerate(zip(results, slots)):
+        values = normalize(np.asarray(scores, dtype=np.float64))
+        if len(values):
+            normalized[row] = values.min()
+        normalized[row, slot] = values
+
+    fused = np.zeros(len(doc_ids), dtype=np.float64)
+    for weight, row in zip(weights, normalized):
+        fused += weight * row
+
+    selected = top_k(fused, limit)
+    return doc_ids[selected], fused[selected], normalized[:, selected]
+
+def rrf_fusion(results: list[tuple[np.ndarray, np.ndarray]], k: int, limit: int, weights: list[float] = None):
+    if weights is not None and len(weights) != len(results):
+        raise ValueError("Expected one weight per retriever")
+
+    doc_ids, slots = align([ids for ids, _ in results])
+
+    # rank 0 marks a document the retriever did not return
+    ranks = np.zeros((len(results), len(doc_ids)), dtype=np.int64)
+    for row, ((_, scores), slot) in enumerate(zip(results, slots)):
+        ranks[row, slot] = rank_scores(np.asarray(scores, dtype=np.float64))
+
+    fused = np.zeros(len(doc_ids), dtype=np.float64)
+    for row, retriever_ranks in enumerate(ranks):
+        contribution = rrf_scores(retriever_ranks, k)
+        fused += contribution if weights is None else weights[row] * contribution
+
+    selected = top_k(fused, limit)
+    return doc_ids[selected], fused[selected], ranks[:, selected]
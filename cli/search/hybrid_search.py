@@ -1,14 +1,25 @@
-import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+
+import numpy as np
 from nltk.stem import PorterStemmer
 from .inverted_index import InvertedIndex
 
 from .data_processing import (
     data_read, stopwords_read, DataPreprocessor, BM25_K1, BM25_B
 )
-from .chunked_semantic_search import ChunkedSemanticSearch
+from .chunked_semantic_search import SCORE_PRECISION, ChunkedSemanticSearch
+from .fusion import rrf_fusion, weighted_fusion
+from .vector_index import top_k
 
+# default candidate depth per retriever is limit * multiplier
 multiplier = 500
 
+# adaptive depth starts at limit * ADAPTIVE_START_MULTIPLIER and doubles until the fused top-k stops changing
+ADAPTIVE_START_MULTIPLIER = 4
+
 def min_max_normalize(scores: list[float]) -> list[float]:
     if len(scores) == 0:
         return []
@@ -23,22 +34,15 @@ def min_max_normalize(scores: list[float]) -> list[float]:
         map(lambda score: (score - min_score) / (max_score - min_score), scores)
     )
 
-def rrf_score(rank, k=60):
-    return 1 / (k + rank)
-
-def extract_id_from_idx(element: str) -> int:
-    return int(element[element.index('(') + 1:element.index(')')])
-
-def extract_score_from_idx(element: str) -> float:
-    return float(element[element.rindex(':') + 1 :].strip())
-
-def hybrid_score(bm25_score, semantic_score, alpha=0.5):
-    return alpha * bm25_score + (1 - alpha) * semantic_score
-
 class HybridSearch:
-    def __init__(self, documents):
+    def __init__(self, documents, query_cache_path: str = None, workers: int = 2, bm25_depth: int = None, semantic_depth: int = None):
         self.documents = documents
-        self.semantic_search = ChunkedSemanticSearch()
+        self.bm25_depth = bm25_depth
+        self.semantic_depth = semantic_depth
+        self.executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="retriever")
+        # one instance serves concurrent queries, so each thread sees the timings of its own last search
+        self.local = threading.local()
+        self.semantic_search = ChunkedSemanticSearch(query_cache_path=query_cache_path)
         self.semantic_search.load_or_create_embeddings(documents)
         self.semantic_search.load_or_create_chunk_embeddings(documents)
 
@@ -49,89 +53,146 @@ class HybridSearch:
         )
 
         self.idx = InvertedIndex(data_preprocessor=data_preprocessor)
-        if not os.path.exists(self.idx.index_path):
+        try:
+            self.idx.load()
+        except FileNotFoundError:
             self.idx.build(documents)
             self.idx.save()
 
-    def _bm25_search(self, query, limit):
-        self.idx.load()
-        return self.idx.bm25_search(query, limit)
-
-    def weighted_search(self, query, alpha, limit=5):
-        inverted_index_results = list(map(
-            lambda x: (extract_id_from_idx(x), extract_score_from_idx(x)) ,
-            self._bm25_search(query, limit * multiplier)
-        ))
-
-        semantic_search_results = list(map(
-            lambda x: (int(x["id"]), float(x["score"])),
-            self.semantic_search.search_chunks(query, limit * multiplier)
-        ))
-
-        normalized_bm25_scores = min_max_normalize(list(map(lambda x: x[1], inverted_index_results)))
-        normalized_semantic_scores = min_max_normalize(list(map(lambda x: x[1], semantic_search_results)))
+    def _bm25_scores(self, query):
+        self.idx.load_if_changed()
+        return self.idx.bm25_scores(query)
+
+    def _select(self, candidates, depth, precision=None) -> tuple[np.ndarray, np.ndarray]:
+        doc_ids, scores = candidates
+        selected = top_k(scores, depth)
+        if precision is None:
+            return doc_ids[selected].astype(np.int64), scores[selected].astype(np.float64)
+        # semantic scores are fused at the precision the semantic search reports them
+        return doc_ids[selected].astype(np.int64), np.array([round(float(score), precision) for score in scores[selected]], dtype=np.float64)
+
+    @property
+    def timings(self):
+        return getattr(self.local, "timings", None)
+
+    def _timed(self, name, function, *args):
+        started = time.perf_counter()
+        result = function(*args)
+        return name, result, time.perf_counter() - started
+
+    def _retrieve(self, bm25_search, semantic_search):
+        # Both retrievers spend most of their time in NumPy / the encoder, which
+        # release the GIL, so running them side by side costs max() instead of sum().
+        started = time.perf_counter()
+        futures = [
+            self.executor.submit(self._timed, "bm25", *bm25_search),
+            self.executor.submit(self._timed, "semantic", *semantic_search),
+        ]
 
         results = {}
+        timings = {}
+        for future in futures:
+            name, result, seconds = future.result()
+            results[name] = result
+            timings[name] = seconds
+        timings["total"] = time.perf_counter() - started
+
+        return results["bm25"], results["semantic"], timings
+
+    def _score_many(self, queries):
+        # full score arrays per query, each depth is then only a top-k selection over them
+        inverted_index_scores, semantic_search_scores, timings = self._retrieve(
+            (lambda: [self._bm25_scores(query) for query in queries],),
+            (self.semantic_search.movie_scores_many, queries)
+        )
+        return list(zip(inverted_index_scores, semantic_search_scores)), timings
 
-        for index, element in enumerate(inverted_index_results):
-            key = element[0]
-            value = results.get(key, { "semantic_score": 0.0, "document": self.idx.docmap.get(key) })
-            value["keyword_score"] = normalized_bm25_scores[index]
-            results[key] = value
-
-        for index, element in enumerate(semantic_search_results):
-            key = element[0]
-            value = results.get(key, { "keyword_score": 0.0, "document": self.idx.docmap.get(key) })
-            value["semantic_score"] = normalized_semantic_scores[index]
-            results[key] = value
-
-        for element in results.items():
-            value = element[1]
-            value["hybrid_score"] = hybrid_score(value["keyword_score"], value["semantic_score"], alpha)
-
-        return sorted(results.values(), key=lambda x: x["hybrid_score"], reverse=True)[:limit]
-
-    def rrf_search(self, query, k, limit=10):
-        inverted_index_results = list(map(
-            lambda x: (extract_id_from_idx(x), extract_score_from_idx(x)) ,
-            self._bm25_search(query, limit * multiplier)
-        ))
-
-        semantic_search_results = list(map(
-            lambda x: (int(x["id"]), float(x["score"])),
-            self.semantic_search.search_chunks(query, limit * multiplier)
-        ))
-
-        results = {}
-
-        for index, element in enumerate(sorted(inverted_index_results, key=lambda x: x[1], reverse=True), start=1):
-            key = element[0]
-            value = results.get(key, { "document": self.idx.docmap.get(key) })
-            value["bm25_rank"] = index
-            results[key] = value
-
-        for index, element in enumerate(sorted(semantic_search_results, key=lambda x: x[1], reverse=True), start=1):
-            key = element[0]
-            value = results.get(key, {"document": self.idx.docmap.get(key)})
-            value["semantic_rank"] = index
-            results[key] = value
-
-        for element in results.items():
-            value = element[1]
-
-            rrf_bm25 = 0.0
-            rrf_semantic = 0.0
+    def candidate_depths(self, limit, bm25_depth=None, semantic_depth=None):
+        return (
+            bm25_depth or self.bm25_depth or limit * multiplier,
+            semantic_depth or self.semantic_depth or limit * multiplier,
+        )
 
-            bm25_rank = value.get("bm25_rank")
-            semantic_rank = value.get("semantic_rank")
+    def _fused_search_many(self, queries, limit, fusion, bm25_depth=None, semantic_depth=None, adaptive=False):
+        max_bm25_depth, max_semantic_depth = self.candidate_depths(limit, bm25_depth, semantic_depth)
+        scored, timings = self._score_many(queries)
+        self.local.timings = timings
+        if not adaptive:
+            return [
+                fusion(self._select(inverted_index_scores, max_bm25_depth), self._select(semantic_search_scores, max_semantic_depth, SCORE_PRECISION))
+                for inverted_index_scores, semantic_search_scores in scored
+            ]
+
+        results = [None] * len(queries)
+        rankings = [None] * len(queries)
+        pending = list(range(len(queries)))
+        timings["rounds"] = 0
+        depth = limit * ADAPTIVE_START_MULTIPLIER
+
+        while pending:
+            bm25_depth = min(depth, max_bm25_depth)
+            semantic_depth = min(depth, max_semantic_depth)
+            at_max_depth = bm25_depth == max_bm25_depth and semantic_depth == max_semantic_depth
+            timings["rounds"] += 1
+            timings["depth"] = max(bm25_depth, semantic_depth)
+
+            still_pending = []
+            for index in pending:
+                inverted_index_scores, semantic_search_scores = scored[index]
+                inverted_index_results = self._select(inverted_index_scores, bm25_depth)
+                semantic_search_results = self._select(semantic_search_scores, semantic_depth, SCORE_PRECISION)
+                results[index] = fusion(inverted_index_results, semantic_search_results)
+                ranking = [result["document"]["id"] for result in results[index]]
+                drained = len(inverted_index_results[0]) < bm25_depth and len(semantic_search_results[0]) < semantic_depth
+
+                if not (at_max_depth or drained or ranking == rankings[index]):
+                    rankings[index] = ranking
+                    still_pending.append(index)
+
+            pending = still_pending
+            depth *= 2
+
+        return results
+
+    def weighted_search(self, query, alpha, limit=5, bm25_depth=None, semantic_depth=None, adaptive=False, normalization="min_max"):
+        return self.weighted_search_many([query], alpha, limit, bm25_depth, semantic_depth, adaptive, normalization)[0]
+
+    def weighted_search_many(self, queries, alpha, limit=5, bm25_depth=None, semantic_depth=None, adaptive=False, normalization="min_max"):
+        fusion = partial(self._weighted_fusion, alpha=alpha, limit=limit, normalization=normalization)
+        return self._fused_search_many(queries, limit, fusion, bm25_depth, semantic_depth, adaptive)
+
+    def rrf_search(self, query, k, limit=10, bm25_depth=None, semantic_depth=None, adaptive=False):
+        return self.rrf_search_many([query], k, limit, bm25_depth, semantic_depth, adaptive)[0]
+
+    def rrf_search_many(self, queries, k, limit=10, bm25_depth=None, semantic_depth=None, adaptive=False):
+        fusion = partial(self._rrf_fusion, k=k, limit=limit)
+        return self._fused_search_many(queries, limit, fusion, bm25_depth, semantic_depth, adaptive)
+
+    def _weighted_fusion(self, inverted_index_results, semantic_search_results, alpha, limit, normalization="min_max"):
+        doc_ids, hybrid_scores, normalized_scores = weighted_fusion(
+            [inverted_index_results, semantic_search_results], [alpha, 1 - alpha], limit, normalization
+        )
 
+        return [
+            {
+                "document": self.idx.docmap.get(int(doc_id)),
+                "keyword_score": float(keyword_score),
+                "semantic_score": float(semantic_score),
+                "hybrid_score": float(score),
+            }
+            for doc_id, score, keyword_score, semantic_score in zip(doc_ids, hybrid_scores, *normalized_scores)
+        ]
+
+    def _rrf_fusion(self, inverted_index_results, semantic_search_results, k, limit):
+        doc_ids, rrf_scores, ranks = rrf_fusion([inverted_index_results, semantic_search_results], k, limit)
+
+        results = []
+        for doc_id, score, bm25_rank, semantic_rank in zip(doc_ids, rrf_scores, *ranks):
+            value = {"document": self.idx.docmap.get(int(doc_id)), "rrf_score": float(score)}
             if bm25_rank:
-                rrf_bm25 = rrf_score(bm25_rank, k)
-
+                value["bm25_rank"] = int(bm25_rank)
             if semantic_rank:
-                rrf_semantic = rrf_score(semantic_rank, k)
-
-            rrf_combined = rrf_bm25 + rrf_semantic
-            value["rrf_score"] = rrf_combined
+                value["semantic_rank"] = int(semantic_rank)
+            results.append(value)
 
-        return sorted(results.values(), key=lambda x: x["rrf_score"], reverse=True)[:limit]
+        return results
@@ -0,0 +1,198 @@
+import json
+import os
+import shutil
+from itertools import islice
+from typing import Iterable, Iterator
+
+import numpy as np
+
+DOCUMENT_BATCH_SIZE = 256
+READ_SIZE = 1 << 16
+JSON_LINES_EXTENSIONS = (".jsonl", ".ndjson")
+NUMBER_START = "-0123456789"
+
+class JsonStream:
+    def __init__(self, file, read_size: int = READ_SIZE):
+        self.file = file
+        self.read_size = read_size
+        self.decoder = json.JSONDecoder()
+        self.buffer = ""
+        self.position = 0
+        self.eof = False
+
+    def fill(self) -> bool:
+        chunk = self.file.read(self.read_size)
+        self.buffer = self.buffer[self.position:] + chunk
+        self.position = 0
+        self.eof = chunk == ""
+        return not self.eof
+
+    def peek(self) -> str:
+        while True:
+            while self.position < len(self.buffer) and self.buffer[self.position].isspace():
+                self.position += 1
+            if self.position < len(self.buffer):
+                return self.buffer[self.position]
+            if not self.fill():
+                raise ValueError("Unexpected end of JSON input")
+
+    def expect(self, character: str) -> None:
+        if self.peek() != character:
+            raise ValueError(f"Expected '{character}' at JSON input, found '{self.buffer[self.position]}'")
+        self.position += 1
+
+    def complete(self, end: int) -> bool:
+        # a number cut by a read (e.g. "2." or "1e") decodes as a shorter one, so it
+        # only counts as finished once a delimiter follows it
+        if self.eof or self.buffer[self.position] not in NUMBER_START:
+            return True
+        return end < len(self.buffer) and (self.buffer[end] in ",]}" or self.buffer[end].isspace())
+
+    def value(self):
+        while True:
+            self.peek()
+            try:
+                value, end = self.decoder.raw_decode(self.buffer, self.position)
+                if self.complete(end):
+                    self.position = end
+                    return value
+            except json.JSONDecodeError:
+                if self.eof:
+                    raise
+            self.fill()
+
+    def array(self) -> Iterator:
+        self.expect("[")
+        if self.peek() == "]":
+            self.position += 1
+            return
+
+        while True:
+            yield self.value()
+            if self.peek() == "]":
+                self.position += 1
+                return
+            self.expect(",")
+
+def iter_json_array(file_path: str, key: str = "movies") -> Iterator[dict]:
+    with open(file_path, "r", encoding="utf-8") as file:
+        stream = JsonStream(file)
+        if stream.peek() == "[":
+            yield from stream.array()
+            return
+
+        stream.expect("{")
+        while stream.peek() != "}":
+            name = stream.value()
+            stream.expect(":")
+            if name == key:
+                yield from stream.array()
+                return
+
+            stream.value()
+            if stream.peek() == ",":
+                stream.position += 1
+
+        raise KeyError(f"{file_path} has no '{key}' array")
+
+def iter_json_lines(file_path: str) -> Iterator[dict]:
+    with open(file_path, "r", encoding="utf-8") as file:
+        for line in file:
+            if line.strip():
+                yield json.loads(line)
+
+def iter_documents(file_path: str, key: str = "movies") -> Iterator[dict]:
+    if file_path.endswith(JSON_LINES_EXTENSIONS):
+        return iter_json_lines(file_path)
+    return iter_json_array(file_path, key)
+
+def source_signature(file_path: str) -> dict:
+    stat = os.stat(file_path)
+    return {"path": os.path.abspath(file_path), "size": stat.st_size, "mtime_ns": stat.st_mtime_ns}
+
+def batched(items: Iterable, size: int) -> Iterator[list]:
+    iterator = iter(items)
+    while batch := list(islice(iterator, size)):
+        yield batch
+
+class IngestCheckpoint:
+    def __init__(self, directory: str, parameters: dict, source: str = None):
+        # a checkpoint is only resumed for the same source file, unchanged since it was started
+        if source is not None:
+            parameters = dict(parameters, source=source_signature(source))
+        self.directory = directory
+        self.state_path = os.path.join(directory, "state.json")
+        self.state = self.__read_state()
+
+        if self.state is None or self.state.get("parameters") != parameters:
+            shutil.rmtree(directory, ignore_errors=True)
+            os.makedirs(directory, exist_ok=True)
+            self.state = {"parameters": parameters, "documents": 0, "parts": []}
+            self.__write_state()
+
+    @property
+    def documents(self) -> int:
+        return self.state["documents"]
+
+    def remaining(self, documents: Iterable[dict]) -> Iterator[dict]:
+        return islice(documents, self.documents, None)
+
+    def write_part(self, documents: int, **arrays: np.ndarray) -> None:
+        name = f"part-{len(self.state['parts']):06d}.npz"
+        file_path = os.path.join(self.directory, name)
+        temp_path = f"{file_path}.tmp"
+        with open(temp_path, "wb") as file:
+            np.savez(file, **arrays)
+        os.replace(temp_path, file_path)
+
+        self.state["parts"].append(name)
+        self.state["documents"] += documents
+        self.__write_state()
+
+    def parts(self) -> Iterator[dict[str, np.ndarray]]:
+        for name in self.state["parts"]:
+            with np.load(os.path.join(self.directory, name)) as data:
+                yield {key: data[key] for key in data.files}
+
+    def concatenate(self, key: str) -> np.ndarray:
+        return np.concatenate([part[key] for part in self.parts()] or [np.empty(0)])
+
+    def write_rows(self, key: str, file_path: str) -> None:
+        # rows are copied part by part into a memory-mapped .npy, so the full
+        # matrix never has to fit in memory
+        row_count = 0
+        row_shape, dtype = None, None
+        for part in self.parts():
+            if len(part[key]):
+                row_count += len(part[key])
+                row_shape, dtype = part[key].shape[1:], part[key].dtype
+
+        temp_path = f"{file_path}.tmp"
+        output = np.lib.format.open_memmap(temp_path, mode="w+", dtype=dtype if dtype is not None else np.float32, shape=(row_count, *(row_shape or (0,))))
+        position = 0
+        for part in self.parts():
+            if len(part[key]):
+                output[position:position + len(part[key])] = part[key]
+                position += len(part[key])
+        output.flush()
+        del output
+        os.replace(temp_path, file_path)
+
+    def clear(self) -> None:
+        shutil.rmtree(self.directory, ignore_errors=True)
+
+    def __read_state(self) -> dict | None:
+        if not os.path.exists(self.state_path):
+            return None
+
+        with open(self.state_path, "r") as file:
+            try:
+                return json.load(file)
+            except json.JSONDecodeError:
+                return None
+
+    def __write_state(self) -> None:
+        temp_path = f"{self.state_path}.tmp"
+        with open(temp_path, "w") as file:
+            json.dump(self.state, file)
+        os.replace(temp_path, self.state_path)
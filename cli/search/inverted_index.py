@@ -1,11 +1,24 @@
+import json
 import os
 import pickle
 import math
-from collections import Counter
+import threading
+import time
+from collections import Counter, deque
+from concurrent.futures import ProcessPoolExecutor
 from functools import reduce
+from itertools import chain
 
+import numpy as np
+
+from .compiled_index import CompiledIndex, CompactIndex, bm25_tf, write_compact_index
 from .data_processing import DataPreprocessor, BM25_K1, BM25_B
+from .ingestion import batched
+from .vector_index import top_k
+
 
+INDEX_FILES = ("index.bin", "docmap.json")
+LEGACY_CACHE_FILES = ("index.pkl", "docmap.pkl", "doc_lengths.pkl", "term_frequencies.pkl")
 
 def read_data(file_path: str) -> dict:
     if not os.path.exists(file_path):
@@ -14,14 +27,21 @@ def read_data(file_path: str) -> dict:
     with open(file_path, "rb") as file:
         return pickle.load(file)
 
-def write_data(file_path: str, data: dict) -> None:
-    with open(file_path, "wb") as file:
-        pickle.dump(data, file)
-
 def format_bm25_search(index: int, element: tuple[int, float], metadata: dict) -> str:
     doc_id, score = element
     return f"{index}. ({doc_id}) {metadata['title']} - Score: {score:.2f}"
 
+shard_preprocessor = None
+
+def init_shard_worker(data_preprocessor: DataPreprocessor) -> None:
+    global shard_preprocessor
+    shard_preprocessor = data_preprocessor
+
+def build_shard(movies: list[dict]) -> tuple[dict, dict, dict]:
+    shard = InvertedIndex(data_preprocessor=shard_preprocessor)
+    shard.build(movies)
+    return shard.index, shard.doc_lengths, shard.term_frequencies
+
 class InvertedIndex:
 
     def __init__(self, data_preprocessor: DataPreprocessor):
@@ -30,23 +50,36 @@ class InvertedIndex:
         self.doc_lengths = {}
         self.term_frequencies = {}
         self.data_preprocessor = data_preprocessor
-        self.index_path = "cache/index.pkl"
+        self.index_path = "cache/index.bin"
+        self.compiled = None
+        self.materialized = True
+        self.build_stats = None
+        self.loaded_signature = None
+        self.lock = threading.RLock()
 
     def __add_document(self, doc_id: int, text: str):
         tokens = text.split()
         self.doc_lengths[doc_id] = len(tokens)
-        for token in tokens:
-            key = token.lower()
-            element = self.index.get(key, set())
+        if not tokens:
+            return
+
+        counter = Counter(token.lower() for token in tokens)
+        for key in counter:
+            element = self.index.get(key)
+            if element is None:
+                self.index[key] = element = set()
             element.add(doc_id)
-            self.index[key] = element
-            counter = self.term_frequencies.get(doc_id, Counter())
-            counter.update([key])
+
+        existing = self.term_frequencies.get(doc_id)
+        if existing is None:
             self.term_frequencies[doc_id] = counter
+        else:
+            existing.update(counter)
 
     def get_documents(self, term: str):
-        keys = self.index.get(term.lower(), set())
-        return sorted(list(keys))
+        compiled = self.compile()
+        positions, _ = compiled.postings(term.lower())
+        return sorted(int(doc_id) for doc_id in compiled.doc_ids[positions])
 
     def __get_avg_doc_length(self) -> float:
         num_of_documents = len(self.doc_lengths.keys())
@@ -56,12 +89,145 @@ class InvertedIndex:
         sum_of_lengths = reduce(lambda accumulator, current: accumulator + current, self.doc_lengths.values(), 0.0)
         return sum_of_lengths / num_of_documents
 
-    def build(self, movies: list[dict]):
+    def build(self, movies: list[dict], workers: int = 1, shard_size: int = 1000):
+        started = time.perf_counter()
+        self.compiled = None
+
+        # both paths consume any iterable, so a streamed corpus is indexed as it is read
+        if workers > 1:
+            documents = self.__build_parallel(movies, workers, shard_size)
+        else:
+            documents = self.__build_serial(movies)
+
+        seconds = time.perf_counter() - started
+        self.build_stats = {
+            "documents": documents,
+            "workers": workers,
+            "seconds": seconds,
+            "docs_per_second": documents / seconds if seconds > 0 else 0.0,
+        }
+
+    def __build_serial(self, movies) -> int:
+        documents = 0
         for movie in movies:
             doc_id = movie['id']
             text = f"{movie['title']} {movie['description']}"
             self.docmap[doc_id] = movie
             self.__add_document(doc_id, self.data_preprocessor.transform(text))
+            documents += 1
+        return documents
+
+    def __build_parallel(self, movies, workers: int, shard_size: int) -> int:
+        shards = batched(movies, shard_size)
+        first_shard = next(shards, [])
+        second_shard = next(shards, None)
+        if second_shard is None:
+            # a single shard is not worth starting the process pool for
+            return self.__build_serial(first_shard)
+
+        # at most two shards per worker are in flight, and they are merged in the
+        # order they were read, so only that window of the corpus is held at once
+        documents = 0
+        pending = deque()
+        with ProcessPoolExecutor(max_workers=workers, initializer=init_shard_worker, initargs=(self.data_preprocessor,)) as executor:
+            for shard in chain([first_shard, second_shard], shards):
+                for movie in shard:
+                    self.docmap[movie['id']] = movie
+                documents += len(shard)
+
+                pending.append(executor.submit(build_shard, shard))
+                if len(pending) >= workers * 2:
+                    self.__merge_shard(*pending.popleft().result())
+
+            while pending:
+                self.__merge_shard(*pending.popleft().result())
+
+        return documents
+
+    def __merge_shard(self, index: dict, doc_lengths: dict, term_frequencies: dict):
+        for term, doc_ids in index.items():
+            element = self.index.get(term)
+            if element is None:
+                self.index[term] = doc_ids
+            else:
+                element.update(doc_ids)
+
+        for doc_id, counter in term_frequencies.items():
+            existing = self.term_frequencies.get(doc_id)
+            if existing is None:
+                self.term_frequencies[doc_id] = counter
+            else:
+                existing.update(counter)
+
+        self.doc_lengths.update(doc_lengths)
+
+    def materialize(self):
+        with self.lock:
+            if self.materialized:
+                return
+
+            compiled = self.compile()
+            doc_ids = [int(doc_id) for doc_id in compiled.doc_ids]
+            self.doc_lengths = {doc_id: int(length) for doc_id, length in zip(doc_ids, compiled.doc_lengths)}
+            self.index = {}
+            self.term_frequencies = {}
+
+            for term in compiled.terms():
+                positions, term_frequencies = compiled.postings(term)
+                term_doc_ids = [doc_ids[position] for position in positions]
+                self.index[term] = set(term_doc_ids)
+                for doc_id, term_frequency in zip(term_doc_ids, term_frequencies):
+                    counter = self.term_frequencies.get(doc_id, Counter())
+                    counter[term] = int(term_frequency)
+                    self.term_frequencies[doc_id] = counter
+
+            self.materialized = True
+
+    def add_document(self, movie: dict):
+        with self.lock:
+            self.materialize()
+            doc_id = movie['id']
+            if doc_id in self.docmap:
+                self.remove_document(doc_id)
+
+            text = f"{movie['title']} {movie['description']}"
+            self.docmap[doc_id] = movie
+            self.__add_document(doc_id, self.data_preprocessor.transform(text))
+            self.compiled = None
+
+    def update_document(self, movie: dict):
+        self.add_document(movie)
+
+    def remove_document(self, doc_id: int) -> bool:
+        with self.lock:
+            self.materialize()
+            if doc_id not in self.docmap:
+                return False
+
+            for term in self.term_frequencies.pop(doc_id, Counter()):
+                documents = self.index[term]
+                documents.discard(doc_id)
+                if not documents:
+                    del self.index[term]
+
+            del self.docmap[doc_id]
+            self.doc_lengths.pop(doc_id, None)
+            self.compiled = None
+            return True
+
+    def apply_delta(self, delta: dict) -> tuple[int, int]:
+        with self.lock:
+            upserted = 0
+            for movie in delta.get("upsert", []):
+                self.add_document(movie)
+                upserted += 1
+
+            removed = 0
+            for doc_id in delta.get("delete", []):
+                if self.remove_document(doc_id):
+                    removed += 1
+
+            return upserted, removed
 
     def extract_tokens(self, term: str) -> list[str]:
         search_term = self.data_preprocessor.transform(term)
@@ -72,60 +238,159 @@ class InvertedIndex:
         return tokens
 
     def get_tf(self, doc_id: int, term: str) -> int:
-        frequencies = self.term_frequencies.get(doc_id, Counter())
+        compiled = self.compile()
         tokens = self.extract_tokens(term)
-        return frequencies[tokens[0]]
+        position = compiled.position(doc_id)
+        if position is None:
+            return 0
+        return int(compiled.get_tfs(tokens[0], np.array([position]))[0])
 
     def get_bm25_tf(self, doc_id: int, term: str, k1 = BM25_K1, b = BM25_B) -> float:
+        compiled = self.compile()
         term_frequency = self.get_tf(doc_id, term)
-        doc_length = self.doc_lengths[doc_id]
-        length_norm = 1 - b + b * (doc_length / self.__get_avg_doc_length())
-        return term_frequency * (k1 + 1) / (term_frequency + k1 * length_norm)
+        position = compiled.position(doc_id)
+        if position is None:
+            raise KeyError(doc_id)
+        doc_length = int(compiled.doc_lengths[position])
+        return bm25_tf(term_frequency, doc_length, compiled.avg_doc_length, k1, b)
 
     def get_idf(self, term: str) -> float:
-        doc_count = len(self.docmap.keys())
+        compiled = self.compile()
         tokens = self.extract_tokens(term)
-        term_doc_count = reduce(
-            lambda accumulator, current: accumulator + (1 if current.get(tokens[0], 0) > 0 else 0),
-            self.term_frequencies.values(),
-            0
-        )
+        doc_count = len(compiled.doc_ids)
+        term_doc_count = compiled.document_frequency(tokens[0])
 
         return math.log((doc_count + 1) / (term_doc_count + 1))
 
     def get_bm25_idf(self, term: str) -> float:
-        doc_count = len(self.docmap.keys())
+        compiled = self.compile()
         tokens = self.extract_tokens(term)
-        term_doc_count = reduce(
-            lambda accumulator, current: accumulator + (1 if current.get(tokens[0], 0) > 0 else 0),
-            self.term_frequencies.values(),
-            0
-        )
-
-        return math.log((doc_count - term_doc_count + 0.5) / (term_doc_count + 0.5) + 1)
+        return compiled.get_idf(tokens[0])
 
     def bm25(self, doc_id: int, term: str) -> float:
         return self.get_bm25_tf(doc_id, term) * self.get_bm25_idf(term)
 
-    def bm25_search(self, query: str, limit: int):
-        scores = {}
+    def compile(self) -> CompiledIndex:
+        compiled = self.compiled
+        if compiled is not None:
+            return compiled
+
+        with self.lock:
+            if self.compiled is None:
+                self.compiled = self.__compile()
+            return self.compiled
+
+    def __compile(self) -> CompiledIndex:
+        doc_ids = np.fromiter(self.docmap.keys(), dtype=np.int64, count=len(self.docmap))
+        positions = {doc_id: position for position, doc_id in enumerate(self.docmap.keys())}
+        doc_lengths = np.array([self.doc_lengths.get(doc_id, 0) for doc_id in self.docmap.keys()], dtype=np.float64)
+
+        postings = {}
+        for term, term_doc_ids in self.index.items():
+            term_positions = np.array(sorted(positions[doc_id] for doc_id in term_doc_ids), dtype=np.int32)
+            term_frequencies = np.array([self.term_frequencies[doc_ids[position]][term] for position in term_positions], dtype=np.int32)
+            postings[term] = (term_positions, term_frequencies)
+
+        return CompiledIndex(doc_ids, doc_lengths, self.__get_avg_doc_length(), postings)
+
+    def bm25_search(self, query: str, limit: int, k1 = BM25_K1, b = BM25_B) -> list[tuple[int, float]]:
+        doc_ids, scores = self.bm25_scores(query, k1, b)
+        ranked = top_k(scores, limit)
+
+        return [(int(doc_id), float(score)) for doc_id, score in zip(doc_ids[ranked], scores[ranked])]
+
+    def bm25_scores(self, query: str, k1 = BM25_K1, b = BM25_B) -> tuple[np.ndarray, np.ndarray]:
+        # every document matching at least one query term, in index order
+        compiled = self.compile()
         tokens = self.extract_tokens(query)
 
+        scores = np.zeros(len(compiled.doc_ids), dtype=np.float64)
+        matched = np.zeros(len(compiled.doc_ids), dtype=bool)
+
         for token in tokens:
-            for doc_id in list(self.index.get(token, [])):
-                value = scores.get(doc_id, 0.0)
-                scores[doc_id] = value + self.bm25(doc_id, token)
+            positions, term_frequencies = compiled.postings(token)
+            if len(positions) == 0:
+                continue
+
+            # bm25() re-runs the preprocessing on an already stemmed token, keep
+            # scoring against that term so the results stay the same
+            term = self.extract_tokens(token)[0]
+            if term != token:
+                term_frequencies = compiled.get_tfs(term, positions)
 
-        sorted_scores = dict(sorted(scores.items(), key=lambda item: item[1], reverse=True))
-        result = list(map(lambda x: format_bm25_search(x[0], x[1], self.docmap[x[1][0]]), enumerate(list(sorted_scores.items())[:limit], start=1)))
-        return result
+            tf = bm25_tf(term_frequencies, compiled.doc_lengths[positions], compiled.avg_doc_length, k1, b)
+            scores[positions] += tf * compiled.get_idf(term)
+            matched[positions] = True
+
+        candidates = np.flatnonzero(matched)
+        return compiled.doc_ids[candidates], scores[candidates]
+
+    def cache_files(self, path_name: str = '.') -> list[str]:
+        cache_dir = os.path.join(path_name, "cache")
+        if os.path.exists(os.path.join(cache_dir, INDEX_FILES[0])):
+            return [os.path.join(cache_dir, file_name) for file_name in INDEX_FILES]
+        return [os.path.join(cache_dir, file_name) for file_name in LEGACY_CACHE_FILES]
+
+    def cache_signature(self, path_name: str = '.') -> tuple:
+        signature = []
+        for file_path in self.cache_files(path_name):
+            try:
+                stat = os.stat(file_path)
+            except FileNotFoundError:
+                return None
+            signature.append((stat.st_mtime_ns, stat.st_size))
+        return tuple(signature)
 
     def load(self, path_name: str = '.'):
         cache_dir = os.path.join(path_name, "cache")
-        self.index = read_data(os.path.join(cache_dir, "index.pkl"))
-        self.docmap = read_data(os.path.join(cache_dir, "docmap.pkl"))
-        self.doc_lengths = read_data(os.path.join(cache_dir, "doc_lengths.pkl"))
-        self.term_frequencies = read_data(os.path.join(cache_dir, "term_frequencies.pkl"))
+        if not os.path.exists(os.path.join(cache_dir, INDEX_FILES[0])) and os.path.exists(os.path.join(cache_dir, LEGACY_CACHE_FILES[0])):
+            return self.load_legacy(path_name)
+
+        with self.lock:
+            signature = self.cache_signature(path_name)
+            compiled = CompactIndex(os.path.join(cache_dir, "index.bin"))
+
+            docmap_path = os.path.join(cache_dir, "docmap.json")
+            if not os.path.exists(docmap_path):
+                raise FileNotFoundError(f"{docmap_path} doesn't exist")
+            with open(docmap_path, "r") as file:
+                documents = json.load(file)
+
+            self.index = {}
+            self.doc_lengths = {}
+            self.term_frequencies = {}
+            self.docmap = {int(doc_id): document for doc_id, document in zip(compiled.doc_ids, documents)}
+            self.compiled = compiled
+            self.materialized = False
+            self.loaded_signature = signature
+
+    def load_legacy(self, path_name: str = '.'):
+        cache_dir = os.path.join(path_name, "cache")
+        with self.lock:
+            signature = self.cache_signature(path_name)
+            index = read_data(os.path.join(cache_dir, "index.pkl"))
+            docmap = read_data(os.path.join(cache_dir, "docmap.pkl"))
+            doc_lengths = read_data(os.path.join(cache_dir, "doc_lengths.pkl"))
+            term_frequencies = read_data(os.path.join(cache_dir, "term_frequencies.pkl"))
+
+            self.index = index
+            self.docmap = docmap
+            self.doc_lengths = doc_lengths
+            self.term_frequencies = term_frequencies
+            self.compiled = None
+            self.materialized = True
+            self.loaded_signature = signature
+
+    def load_if_changed(self, path_name: str = '.') -> bool:
+        signature = self.cache_signature(path_name)
+        if signature is not None and signature == self.loaded_signature:
+            return False
+
+        with self.lock:
+            if signature is not None and signature == self.loaded_signature:
+                return False
+            self.load(path_name)
+            return True
 
     def save(self, path_name: str = '.'):
         cache_dir = os.path.join(path_name, "cache")
@@ -133,7 +398,17 @@ class InvertedIndex:
         if not os.path.isdir(cache_dir):
             os.mkdir(cache_dir)
 
-        write_data(os.path.join(cache_dir, "index.pkl"), self.index)
-        write_data(os.path.join(cache_dir, "docmap.pkl"), self.docmap)
-        write_data(os.path.join(cache_dir, "doc_lengths.pkl"), self.doc_lengths)
-        write_data(os.path.join(cache_dir, "term_frequencies.pkl"), self.term_frequencies)
+        with self.lock:
+            compiled = self.compile()
+
+            docmap_path = os.path.join(cache_dir, "docmap.json")
+            with open(f"{docmap_path}.tmp", "w") as file:
+                json.dump([self.docmap[int(doc_id)] for doc_id in compiled.doc_ids], file)
+            os.replace(f"{docmap_path}.tmp", docmap_path)
+
+            write_compact_index(os.path.join(cache_dir, "index.bin"), compiled)
+            self.loaded_signature = self.cache_signature(path_name)
+
+    def convert_legacy_cache(self, path_name: str = '.'):
+        self.load_legacy(path_name)
+        self.save(path_name)
@@ -0,0 +1,103 @@
+import os
+
+import numpy as np
+
+from .vector_index import SCORE_BLOCK_SIZE, VectorIndex, normalize_rows, normalize_vector, top_k
+
+DEFAULT_NPROBE = 8
+KMEANS_ITERATIONS = 10
+# k-means is trained on at most this many vectors per list
+TRAINING_POINTS_PER_LIST = 64
+
+def default_list_count(vector_count: int) -> int:
+    return max(1, min(vector_count, int(4 * np.sqrt(vector_count))))
+
+def float_block(index: VectorIndex, start: int, end: int) -> np.ndarray:
+    # int8 rows only differ from the stored vectors by a positive per-row scale,
+    # which normalizing removes again
+    return normalize_rows(index.vectors[start:end])
+
+def assign(index: VectorIndex, centroids: np.ndarray) -> np.ndarray:
+    assignments = np.empty(len(index), dtype=np.int32)
+    for start in range(0, len(index), SCORE_BLOCK_SIZE):
+        end = start + SCORE_BLOCK_SIZE
+        assignments[start:end] = np.argmax(float_block(index, start, end) @ centroids.T, axis=1)
+    return assignments
+
+def spherical_kmeans(vectors: np.ndarray, list_count: int, iterations: int = KMEANS_ITERATIONS, seed: int = 0) -> np.ndarray:
+    generator = np.random.default_rng(seed)
+    centroids = vectors[generator.choice(len(vectors), list_count, replace=False)].copy()
+
+    for _ in range(iterations):
+        assignments = np.argmax(vectors @ centroids.T, axis=1)
+        sums = np.zeros_like(centroids)
+        np.add.at(sums, assignments, vectors)
+
+        # lists that lost all their points are re-seeded from random vectors
+        empty = np.flatnonzero(np.bincount(assignments, minlength=list_count) == 0)
+        sums[empty] = vectors[generator.choice(len(vectors), len(empty), replace=False)]
+        centroids = normalize_rows(sums)
+
+    return centroids
+
+class IVFIndex:
+    def __init__(self, centroids: np.ndarray, list_offsets: np.ndarray, list_rows: np.ndarray):
+        self.centroids = centroids
+        self.list_offsets = list_offsets
+        self.list_rows = list_rows
+
+    @classmethod
+    def build(cls, index: VectorIndex, list_count: int = None, iterations: int = KMEANS_ITERATIONS, seed: int = 0) -> "IVFIndex":
+        list_count = list_count or default_list_count(len(index))
+
+        generator = np.random.default_rng(seed)
+        sample_size = min(len(index), list_count * TRAINING_POINTS_PER_LIST)
+        sample = np.sort(generator.choice(len(index), sample_size, replace=False))
+        centroids = spherical_kmeans(normalize_rows(index.vectors[sample]), list_count, iterations, seed)
+
+        assignments = assign(index, centroids)
+        list_rows = np.argsort(assignments, kind="stable").astype(np.int32)
+        list_offsets = np.zeros(list_count + 1, dtype=np.int64)
+        list_offsets[1:] = np.cumsum(np.bincount(assignments, minlength=list_count))
+
+        return cls(centroids, list_offsets, list_rows)
+
+    @staticmethod
+    def file_path(prefix: str) -> str:
+        return f"{prefix}.ivf.npz"
+
+    @classmethod
+    def load(cls, prefix: str) -> "IVFIndex | None":
+        file_path = cls.file_path(prefix)
+        if not os.path.exists(file_path):
+            return None
+
+        with np.load(file_path) as data:
+            return cls(data["centroids"], data["list_offsets"], data["list_rows"])
+
+    def save(self, prefix: str) -> None:
+        file_path = self.file_path(prefix)
+        temp_path = f"{file_path}.tmp"
+        with open(temp_path, "wb") as file:
+            np.savez(file, centroids=self.centroids, list_offsets=self.list_offsets, list_rows=self.list_rows)
+        os.replace(temp_path, file_path)
+
+    def __len__(self) -> int:
+        return len(self.list_rows)
+
+    @property
+    def list_count(self) -> int:
+        return len(self.centroids)
+
+    def candidates(self, query_embedding: np.ndarray, nprobe: int = DEFAULT_NPROBE) -> np.ndarray:
+        lists = top_k(self.centroids @ normalize_vector(query_embedding), nprobe)
+        return np.concatenate(
+            [self.list_rows[self.list_offsets[position]:self.list_offsets[position + 1]] for position in lists]
+            or [np.empty(0, dtype=np.int32)]
+        )
+
+    def search(self, index: VectorIndex, query_embedding: np.ndarray, limit: int, nprobe: int = DEFAULT_NPROBE) -> tuple[np.ndarray, np.ndarray]:
+        rows = self.candidates(query_embedding, nprobe)
+        scores = index.score_rows(query_embedding, rows)
+        selected = top_k(scores, limit)
+        return rows[selected], scores[selected]
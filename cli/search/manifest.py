@@ -0,0 +1,45 @@
+import hashlib
+import json
+import os
+
+MANIFEST_VERSION = 1
+
+def content_hash(text: str) -> str:
+    return hashlib.sha256(text.encode("utf-8")).hexdigest()
+
+def manifest_path(embeddings_path: str) -> str:
+    return f"{os.path.splitext(embeddings_path)[0]}.manifest.json"
+
+def create_manifest(model_name: str, documents: list[tuple[int, str]], **parameters) -> dict:
+    return {
+        "version": MANIFEST_VERSION,
+        "model_name": model_name,
+        "parameters": parameters,
+        "documents": [[doc_id, digest] for doc_id, digest in documents],
+    }
+
+def is_compatible(manifest: dict | None, expected: dict) -> bool:
+    if manifest is None:
+        return False
+
+    return all(manifest.get(key) == expected[key] for key in ("version", "model_name", "parameters"))
+
+def read_manifest(file_path: str) -> dict | None:
+    if not os.path.exists(file_path):
+        return None
+
+    with open(file_path, "r") as file:
+        try:
+            return json.load(file)
+        except json.JSONDecodeError:
+            return None
+
+def write_manifest(file_path: str, manifest: dict) -> None:
+    temp_path = f"{file_path}.tmp"
+    with open(temp_path, "w") as file:
+        json.dump(manifest, file)
+    os.replace(temp_path, file_path)
+
+def remove_manifest(file_path: str) -> None:
+    if os.path.exists(file_path):
+        os.remove(file_path)
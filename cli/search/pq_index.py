@@ -0,0 +1,132 @@
+import math
+import os
+
+import numpy as np
+
+from .vector_index import SCORE_BLOCK_SIZE, normalize_rows, normalize_vector, save_array, top_k
+
+PQ_STORAGE = "pq"
+
+# 48 sub-vectors of 8 dimensions for 384-d MiniLM embeddings: 48 bytes per chunk instead of 1536
+PQ_SUBVECTORS = 48
+PQ_CENTROIDS = 256
+PQ_ITERATIONS = 15
+PQ_TRAINING_SAMPLE = 65536
+
+def subvector_count(dimensions: int, subvectors: int = PQ_SUBVECTORS) -> int:
+    return math.gcd(dimensions, subvectors)
+
+def kmeans(vectors: np.ndarray, centroid_count: int, iterations: int, generator: np.random.Generator) -> np.ndarray:
+    centroids = vectors[generator.choice(len(vectors), centroid_count, replace=False)].copy()
+
+    for _ in range(iterations):
+        assignments = nearest(vectors, centroids)
+        counts = np.bincount(assignments, minlength=centroid_count)
+        sums = np.zeros_like(centroids)
+        np.add.at(sums, assignments, vectors)
+
+        empty = counts == 0
+        centroids[~empty] = sums[~empty] / counts[~empty, None]
+        centroids[empty] = vectors[generator.choice(len(vectors), int(empty.sum()), replace=False)]
+
+    return centroids
+
+def nearest(vectors: np.ndarray, centroids: np.ndarray) -> np.ndarray:
+    # |x - c|^2 without the |x|^2 term, which is the same for every centroid
+    distances = (centroids ** 2).sum(axis=1) - 2 * vectors @ centroids.T
+    return np.argmin(distances, axis=1)
+
+class PQIndex:
+    # codes are stored sub-vector major, (subvectors, chunks), so that every
+    # lookup-table gather in score() walks one contiguous row
+    def __init__(self, codebooks: np.ndarray, codes: np.ndarray):
+        self.codebooks = codebooks
+        self.codes = codes
+
+    @classmethod
+    def train(cls, embeddings: np.ndarray, subvectors: int = PQ_SUBVECTORS, seed: int = 0) -> "PQIndex":
+        subvectors = subvector_count(embeddings.shape[1], subvectors)
+        sub_dimensions = embeddings.shape[1] // subvectors
+
+        generator = np.random.default_rng(seed)
+        sample = np.sort(generator.choice(len(embeddings), min(len(embeddings), PQ_TRAINING_SAMPLE), replace=False))
+        training = normalize_rows(embeddings[sample]).reshape(len(sample), subvectors, sub_dimensions)
+
+        centroid_count = min(PQ_CENTROIDS, len(sample))
+        codebooks = np.stack([
+            kmeans(training[:, subvector], centroid_count, PQ_ITERATIONS, generator)
+            for subvector in range(subvectors)
+        ]).astype(np.float32)
+
+        index = cls(codebooks, np.empty((subvectors, len(embeddings)), dtype=np.uint8))
+        for start in range(0, len(embeddings), SCORE_BLOCK_SIZE):
+            end = start + SCORE_BLOCK_SIZE
+            index.codes[:, start:end] = index.encode(embeddings[start:end])
+        return index
+
+    @classmethod
+    def from_embeddings(cls, embeddings: np.ndarray, storage: str = PQ_STORAGE, prefix: str = None) -> "PQIndex":
+        index = cls.train(embeddings)
+        if prefix is not None:
+            index.save(prefix)
+        return index
+
+    @staticmethod
+    def file_paths(prefix: str, storage: str = PQ_STORAGE) -> tuple[str, str]:
+        return f"{prefix}.{storage}.codes.npy", f"{prefix}.{storage}.codebooks.npy"
+
+    @classmethod
+    def load(cls, prefix: str, storage: str = PQ_STORAGE, mmap: bool = False) -> "PQIndex | None":
+        codes_path, codebooks_path = cls.file_paths(prefix, storage)
+        if not os.path.exists(codes_path) or not os.path.exists(codebooks_path):
+            return None
+
+        return cls(np.load(codebooks_path), np.load(codes_path, mmap_mode="r" if mmap else None))
+
+    def save(self, prefix: str) -> None:
+        codes_path, codebooks_path = self.file_paths(prefix)
+        save_array(codebooks_path, self.codebooks)
+        save_array(codes_path, self.codes)
+
+    @property
+    def storage(self) -> str:
+        return PQ_STORAGE
+
+    @property
+    def nbytes(self) -> int:
+        return self.codes.nbytes + self.codebooks.nbytes
+
+    def __len__(self) -> int:
+        return self.codes.shape[1]
+
+    def encode(self, embeddings: np.ndarray) -> np.ndarray:
+        subvectors, _, sub_dimensions = self.codebooks.shape
+        vectors = normalize_rows(embeddings).reshape(len(embeddings), subvectors, sub_dimensions)
+        return np.stack(
+            [nearest(vectors[:, subvector], self.codebooks[subvector]) for subvector in range(subvectors)]
+        ).astype(np.uint8)
+
+    def lookup_table(self, query_embedding: np.ndarray) -> np.ndarray:
+        subvectors, _, sub_dimensions = self.codebooks.shape
+        query = normalize_vector(query_embedding).reshape(subvectors, sub_dimensions)
+        return np.einsum("skd,sd->sk", self.codebooks, query)
+
+    def score_codes(self, lookup_table: np.ndarray, codes: np.ndarray) -> np.ndarray:
+        scores = np.zeros(codes.shape[1], dtype=np.float32)
+        for subvector_table, subvector_codes in zip(lookup_table, codes):
+            scores += subvector_table.take(subvector_codes)
+        return scores
+
+    def score(self, query_embedding: np.ndarray) -> np.ndarray:
+        return self.score_codes(self.lookup_table(query_embedding), self.codes)
+
+    def score_many(self, query_embeddings: np.ndarray) -> np.ndarray:
+        return np.stack([self.score(query_embedding) for query_embedding in query_embeddings])
+
+    def score_rows(self, query_embedding: np.ndarray, rows: np.ndarray) -> np.ndarray:
+        return self.score_codes(self.lookup_table(query_embedding), self.codes[:, rows])
+
+    def search(self, query_embedding: np.ndarray, limit: int) -> tuple[np.ndarray, np.ndarray]:
+        scores = self.score(query_embedding)
+        indices = top_k(scores, limit)
+        return indices, scores[indices]
@@ -1,7 +1,116 @@
+import threading
+from collections import OrderedDict
+
+import numpy as np
 from sentence_transformers import CrossEncoder
 
+from .manifest import content_hash
+
+CROSS_ENCODER_MODEL = "cross-encoder/ms-marco-TinyBERT-L2-v2"
+RERANK_BATCH_SIZE = 32
+# document tokens kept per pair, the query and special tokens fit in the rest of the 512 window
+DOCUMENT_TOKEN_BUDGET = 384
+PAIR_CACHE_SIZE = 10_000
+
+rerankers = {}
+rerankers_lock = threading.Lock()
+
+def get_reranker(model_name: str = CROSS_ENCODER_MODEL, batch_size: int = None) -> "CrossEncoderReranker":
+    with rerankers_lock:
+        reranker = rerankers.get(model_name)
+        if reranker is None:
+            rerankers[model_name] = reranker = CrossEncoderReranker(model_name)
+        if batch_size is not None:
+            reranker.batch_size = batch_size
+        return reranker
+
 def cross_encoder_rerank(pairs: list):
-    cross_encoder = CrossEncoder("cross-encoder/ms-marco-TinyBERT-L2-v2")
-    scores = cross_encoder.predict(pairs)
-    return scores
+    return get_reranker().predict(pairs)
+
+def rerank_text(document: dict) -> str:
+    return f"{document.get('title', '')} - {document.get('description', '')}"
+
+class CrossEncoderReranker:
+    def __init__(self, model_name: str = CROSS_ENCODER_MODEL, batch_size: int = RERANK_BATCH_SIZE, token_budget: int = DOCUMENT_TOKEN_BUDGET, cache_size: int = PAIR_CACHE_SIZE):
+        self.model = CrossEncoder(model_name)
+        self.model_name = model_name
+        self.tokenizer = getattr(self.model, "tokenizer", None)
+        self.batch_size = batch_size
+        self.token_budget = token_budget
+        self.cache_size = cache_size
+        self.cache = OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def truncate(self, text: str) -> str:
+        if self.tokenizer is None or not getattr(self.tokenizer, "is_fast", False):
+            # roughly four tokens for every three words
+            words = text.split()
+            limit = self.token_budget * 3 // 4
+            return text if len(words) <= limit else " ".join(words[:limit])
+
+        encoding = self.tokenizer(
+            text, add_special_tokens=False, truncation=True, max_length=self.token_budget, return_offsets_mapping=True
+        )
+        offsets = encoding["offset_mapping"]
+        return text[:offsets[-1][1]] if offsets else text
+
+    def predict(self, pairs: list) -> np.ndarray:
+        if not pairs:
+            return np.empty(0, dtype=np.float32)
+
+        pairs = [[query, self.truncate(text)] for query, text in pairs]
+        return np.asarray(self.model.predict(pairs, batch_size=self.batch_size), dtype=np.float32)
+
+    def scores(self, query: str, documents: list[dict]) -> np.ndarray:
+        return self.rerank_many([query], [documents])[0]
+
+    def rerank_many(self, queries: list[str], documents_per_query: list[list[dict]]) -> list[np.ndarray]:
+        # every uncached (query, document) pair across all queries goes through one
+        # predict call, so the model batches are full even for short result lists;
+        # the text hash in the key keeps an edited document from reusing its old score
+        texts = [[rerank_text(document) for document in documents] for documents in documents_per_query]
+        keys = [
+            [(query, document["id"], content_hash(text)) for document, text in zip(documents, query_texts)]
+            for query, documents, query_texts in zip(queries, documents_per_query, texts)
+        ]
+
+        scores = {}
+        missing = {}
+        with self.lock:
+            for query_keys, query_texts in zip(keys, texts):
+                for key, text in zip(query_keys, query_texts):
+                    if key in scores or key in missing:
+                        continue
+                    if key in self.cache:
+                        self.cache.move_to_end(key)
+                        scores[key] = self.cache[key]
+                        self.hits += 1
+                    else:
+                        missing[key] = text
+                        self.misses += 1
+
+        computed = dict(zip(missing, map(float, self.predict([[query, text] for (query, _, _), text in missing.items()]))))
+        scores.update(computed)
+
+        with self.lock:
+            self.__remember(computed)
+
+        return [np.array([scores[key] for key in query_keys], dtype=np.float32) for query_keys in keys]
+
+    def stats(self) -> dict:
+        lookups = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "size": len(self.cache),
+            "hit_rate": self.hits / lookups if lookups else 0.0,
+        }
 
+    def __remember(self, scores: dict) -> None:
+        for key, score in scores.items():
+            self.cache[key] = score
+            self.cache.move_to_end(key)
+        while len(self.cache) > self.cache_size:
+            self.cache.popitem(last=False)
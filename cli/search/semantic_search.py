@@ -2,7 +2,13 @@ import os
 import numpy as np
 from sentence_transformers import SentenceTransformer
 
+from .embedding_cache import QueryEmbeddingCache, normalize_query
+from .ingestion import DOCUMENT_BATCH_SIZE, IngestCheckpoint, batched
+from .manifest import content_hash, create_manifest, is_compatible, manifest_path, read_manifest, remove_manifest, write_manifest
 from .utils import data_read
+from .ivf_index import IVFIndex
+from .pq_index import PQ_STORAGE, PQIndex
+from .vector_index import STORAGE_TYPES, VectorIndex, save_array
 
 cache_dir = './cache'
 db_file = 'movie_embeddings.npy'
@@ -17,10 +23,31 @@ def cosine_similarity(vec1, vec2):
 
     return dot_product / (norm1 * norm2)
 
+def document_text(document: dict) -> str:
+    return f"{document['title']}: {document['description']}"
+
+def document_entry(document: dict) -> tuple[int, str]:
+    return document.get("id"), content_hash(document_text(document))
+
+def remove_index_variants(prefix: str) -> None:
+    # every variant is derived from the embeddings, so new embeddings leave all of them stale
+    file_paths = [IVFIndex.file_path(prefix), *PQIndex.file_paths(prefix)]
+    for storage in STORAGE_TYPES:
+        file_paths.extend(VectorIndex.file_paths(prefix, storage))
+
+    for file_path in file_paths:
+        if os.path.exists(file_path):
+            os.remove(file_path)
+
 class SemanticSearch:
-    def __init__(self, model_name = "all-MiniLM-L6-v2"):
+    def __init__(self, model_name = "all-MiniLM-L6-v2", mmap: bool = False, storage: str = "float32", query_cache_size: int = 1024, query_cache_path: str = None):
         self.model = SentenceTransformer(model_name)
+        self.model_name = model_name
+        self.query_cache = QueryEmbeddingCache(model_name, query_cache_size, query_cache_path)
+        self.mmap = mmap
+        self.storage = storage
         self.embeddings = None
+        self.index = None
         self.documents = None
         self.document_map = {}
 
@@ -28,11 +55,51 @@ class SemanticSearch:
         if text.strip() == "" or text.isspace():
             raise ValueError("Parameter text is empty")
 
-        result = self.model.encode([text])
-        return result[0]
+        query = normalize_query(text)
+        embedding = self.query_cache.get(query)
+        if embedding is not None:
+            return embedding
 
-    def build_embeddings(self, documents: list[dict]):
-        movies = []
+        result = self.model.encode([query])
+        return self.query_cache.put(query, result[0])
+
+    def generate_embeddings(self, texts: list[str]) -> np.ndarray:
+        if any(text.strip() == "" for text in texts):
+            raise ValueError("Parameter texts contains an empty text")
+
+        queries = [normalize_query(text) for text in texts]
+        embeddings = [self.query_cache.get(query) for query in queries]
+
+        missing = list(dict.fromkeys(query for query, embedding in zip(queries, embeddings) if embedding is None))
+        if missing:
+            encoded = dict(zip(missing, self.model.encode(missing)))
+            embeddings = [
+                embedding if embedding is not None else self.query_cache.put(query, encoded[query])
+                for query, embedding in zip(queries, embeddings)
+            ]
+
+        return np.stack(embeddings)
+
+    def load_or_create_index(self, embeddings: np.ndarray, embeddings_path: str, rebuild: bool = False) -> VectorIndex:
+        prefix = os.path.splitext(embeddings_path)[0]
+        index_type = PQIndex if self.storage == PQ_STORAGE else VectorIndex
+        if rebuild:
+            remove_index_variants(prefix)
+        index = None if rebuild else index_type.load(prefix, self.storage, self.mmap)
+
+        if index is None or len(index) != len(embeddings):
+            index_type.from_embeddings(embeddings, self.storage, prefix)
+            index = index_type.load(prefix, self.storage, self.mmap)
+
+        return index
+
+    def embeddings_manifest(self, documents: list[dict]) -> dict:
+        return create_manifest(
+            self.model_name,
+            [document_entry(document) for document in documents]
+        )
+
+    def register_documents(self, documents: list[dict]) -> None:
         self.documents = documents
 
         for document in documents:
@@ -41,35 +108,99 @@ class SemanticSearch:
                 raise ValueError("Missing 'id' in the document element")
             self.document_map[doc_id] = document
 
-            data = f"{document['title']}: {document['description']}"
-            movies.append(data)
-
-        self.embeddings = self.model.encode(movies, show_progress_bar=True)
-        np.save(os.path.join(cache_dir, db_file), self.embeddings)
+    def save_embeddings(self, embeddings: np.ndarray, documents: list[dict]) -> np.ndarray:
+        remove_manifest(manifest_path(os.path.join(cache_dir, db_file)))
+        save_array(os.path.join(cache_dir, db_file), embeddings)
+        return self.activate_embeddings(self.embeddings_manifest(documents))
+
+    def activate_embeddings(self, manifest: dict) -> np.ndarray:
+        # the manifest maps documents to matrix rows, so callers remove it before
+        # replacing the matrix and it is written back last; a run that dies in
+        # between leaves no manifest and the next load rebuilds from scratch
+        embeddings_path = os.path.join(cache_dir, db_file)
+        # searches score the index, the raw matrix is only read back for rescoring,
+        # IVF training and updates, so it always stays on disk
+        self.embeddings = np.load(embeddings_path, mmap_mode="r")
+        self.index = self.load_or_create_index(self.embeddings, embeddings_path, rebuild=True)
+        write_manifest(manifest_path(embeddings_path), manifest)
         return self.embeddings
 
+    def ingest_embeddings(self, documents, batch_size: int = DOCUMENT_BATCH_SIZE, checkpoint_dir: str = None, source: str = None) -> np.ndarray:
+        # Streams documents through the encoder batch by batch. Every batch is
+        # written as a checkpoint part, so an interrupted run resumes after the
+        # last finished batch instead of starting over.
+        manifest = self.embeddings_manifest([])
+        checkpoint = IngestCheckpoint(
+            checkpoint_dir or os.path.join(cache_dir, "ingest_embeddings"),
+            {key: value for key, value in manifest.items() if key != "documents"},
+            source
+        )
+
+        for batch in batched(checkpoint.remaining(documents), batch_size):
+            doc_ids, hashes = zip(*map(document_entry, batch))
+            if not all(doc_ids):
+                raise ValueError("Missing 'id' in the document element")
+
+            embeddings = self.model.encode([document_text(document) for document in batch])
+            checkpoint.write_part(len(batch), embeddings=embeddings, doc_ids=np.array(doc_ids), hashes=np.array(hashes))
+
+        remove_manifest(manifest_path(os.path.join(cache_dir, db_file)))
+        checkpoint.write_rows("embeddings", os.path.join(cache_dir, db_file))
+        manifest["documents"] = [[int(doc_id), str(digest)] for doc_id, digest in zip(checkpoint.concatenate("doc_ids"), checkpoint.concatenate("hashes"))]
+        embeddings = self.activate_embeddings(manifest)
+        checkpoint.clear()
+        return embeddings
+
+    def build_embeddings(self, documents: list[dict]):
+        self.register_documents(documents)
+        movies = [document_text(document) for document in documents]
+
+        embeddings = self.model.encode(movies, show_progress_bar=True)
+        return self.save_embeddings(embeddings, documents)
+
+    def update_embeddings(self, documents: list[dict], manifest: dict):
+        old_embeddings = np.load(os.path.join(cache_dir, db_file), mmap_mode="r")
+        if len(old_embeddings) != len(manifest["documents"]):
+            return self.build_embeddings(documents)
+
+        self.register_documents(documents)
+        old_rows = {tuple(entry): row for row, entry in enumerate(manifest["documents"])}
+
+        rows = [old_rows.get((document.get("id"), content_hash(document_text(document)))) for document in documents]
+        reused = [index for index, row in enumerate(rows) if row is not None]
+        changed = [index for index, row in enumerate(rows) if row is None]
+
+        embeddings = np.empty((len(documents), old_embeddings.shape[1]), dtype=old_embeddings.dtype)
+        embeddings[reused] = old_embeddings[[rows[index] for index in reused]]
+        if changed:
+            embeddings[changed] = self.model.encode([document_text(documents[index]) for index in changed], show_progress_bar=True)
+
+        return self.save_embeddings(embeddings, documents)
+
     def load_or_create_embeddings(self, documents: list[dict]):
+        expected = self.embeddings_manifest(documents)
+        manifest = read_manifest(manifest_path(os.path.join(cache_dir, db_file)))
+
         if os.path.exists(os.path.join(cache_dir, db_file)):
-            self.embeddings = np.load(os.path.join(cache_dir, db_file))
-            self.documents = documents
-            if len(self.documents) == len(self.embeddings):
-                return self.embeddings
+            if manifest == expected:
+                self.embeddings = np.load(os.path.join(cache_dir, db_file), mmap_mode="r")
+                self.documents = documents
+                if len(self.documents) == len(self.embeddings):
+                    self.index = self.load_or_create_index(self.embeddings, os.path.join(cache_dir, db_file))
+                    return self.embeddings
+
+            if is_compatible(manifest, expected):
+                return self.update_embeddings(documents, manifest)
 
         return self.build_embeddings(documents)
 
     def search(self, query, limit):
-        if self.embeddings is None:
+        if self.index is None:
             raise ValueError("No embeddings loaded. Call `load_or_create_embeddings` first")
 
-        similarities = []
-
         query_embeddings = self.generate_embedding(query)
-        for i, doc_embeddings in enumerate(self.embeddings):
-            similarity = cosine_similarity(query_embeddings, doc_embeddings)
-            similarities.append((similarity, self.documents[i]))
-
-        results = sorted(similarities, key=lambda x: x[0], reverse=True)
-        return results[:limit]
+        indices, similarities = self.index.search(query_embeddings, limit)
+        return [(similarity, self.documents[i]) for i, similarity in zip(indices, similarities)]
 
 def verify_model(semantic_search: SemanticSearch):
     print(f"Model loaded: {semantic_search.model}")
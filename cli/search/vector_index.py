@@ -0,0 +1,158 @@
+import os
+
+import numpy as np
+
+STORAGE_TYPES = ("float32", "float16", "int8")
+
+# rows scored per block when the stored vectors need converting to float32
+SCORE_BLOCK_SIZE = 65536
+
+def save_array(file_path: str, array: np.ndarray) -> None:
+    temp_path = f"{file_path}.tmp"
+    with open(temp_path, "wb") as file:
+        np.save(file, array)
+    os.replace(temp_path, file_path)
+
+def normalize_rows(matrix: np.ndarray) -> np.ndarray:
+    matrix = np.asarray(matrix, dtype=np.float32)
+    norms = np.linalg.norm(matrix, axis=1, keepdims=True)
+    norms[norms == 0] = 1.0
+    return matrix / norms
+
+def normalize_vector(vector: np.ndarray) -> np.ndarray:
+    vector = np.asarray(vector, dtype=np.float32)
+    norm = np.linalg.norm(vector)
+    if norm == 0:
+        return vector
+    return vector / norm
+
+def top_k(scores: np.ndarray, k: int) -> np.ndarray:
+    if k <= 0 or len(scores) == 0:
+        return np.empty(0, dtype=np.intp)
+
+    if k < len(scores):
+        # keep everything tied with the k-th score so ties resolve by position
+        threshold = np.partition(scores, len(scores) - k)[len(scores) - k]
+        candidates = np.flatnonzero(scores >= threshold)
+    else:
+        candidates = np.arange(len(scores))
+
+    order = np.argsort(-scores[candidates], kind="stable")
+    return candidates[order[:k]]
+
+def quantize_rows(matrix: np.ndarray) -> tuple[np.ndarray, np.ndarray]:
+    scales = np.abs(matrix).max(axis=1) / 127
+    scales[scales == 0] = 1.0
+    codes = np.rint(matrix / scales[:, None]).astype(np.int8)
+    return codes, scales.astype(np.float32)
+
+class VectorIndex:
+    def __init__(self, vectors: np.ndarray, scales: np.ndarray = None):
+        self.vectors = vectors
+        self.scales = scales
+
+    @classmethod
+    def from_embeddings(cls, embeddings: np.ndarray, storage: str = "float32", prefix: str = None) -> "VectorIndex":
+        if storage not in STORAGE_TYPES:
+            raise ValueError(f"Unknown storage '{storage}', expected one of {STORAGE_TYPES}")
+
+        # normalized block by block so a memory-mapped matrix is never copied whole as
+        # float32; with a prefix the blocks go straight into memory-mapped files at the
+        # target paths, so the stored copy is never held in memory either
+        if prefix is None:
+            vectors = np.empty(embeddings.shape, dtype=storage)
+            scales = np.empty(len(embeddings), dtype=np.float32) if storage == "int8" else None
+        else:
+            vectors_path, scales_path = cls.file_paths(prefix, storage)
+            vectors = np.lib.format.open_memmap(f"{vectors_path}.tmp", mode="w+", dtype=storage, shape=embeddings.shape)
+            scales = np.lib.format.open_memmap(f"{scales_path}.tmp", mode="w+", dtype=np.float32, shape=(len(embeddings),)) if storage == "int8" else None
+
+        for start in range(0, len(embeddings), SCORE_BLOCK_SIZE):
+            end = start + SCORE_BLOCK_SIZE
+            block = normalize_rows(embeddings[start:end])
+            if scales is not None:
+                vectors[start:end], scales[start:end] = quantize_rows(block)
+            else:
+                vectors[start:end] = block
+
+        if prefix is None:
+            return cls(vectors, scales)
+
+        for array, file_path in ((scales, scales_path), (vectors, vectors_path)):
+            if array is not None:
+                array.flush()
+                os.replace(f"{file_path}.tmp", file_path)
+        del vectors, scales
+        return cls.load(prefix, storage, mmap=True)
+
+    @staticmethod
+    def file_paths(prefix: str, storage: str) -> tuple[str, str]:
+        return f"{prefix}.{storage}.npy", f"{prefix}.{storage}.scales.npy"
+
+    @classmethod
+    def load(cls, prefix: str, storage: str = "float32", mmap: bool = False) -> "VectorIndex | None":
+        vectors_path, scales_path = cls.file_paths(prefix, storage)
+        if not os.path.exists(vectors_path) or (storage == "int8" and not os.path.exists(scales_path)):
+            return None
+
+        mmap_mode = "r" if mmap else None
+        vectors = np.load(vectors_path, mmap_mode=mmap_mode)
+        scales = np.load(scales_path, mmap_mode=mmap_mode) if storage == "int8" else None
+        return cls(vectors, scales)
+
+    def save(self, prefix: str) -> None:
+        vectors_path, scales_path = self.file_paths(prefix, self.storage)
+        save_array(vectors_path, self.vectors)
+        if self.scales is not None:
+            save_array(scales_path, self.scales)
+
+    @property
+    def storage(self) -> str:
+        return str(self.vectors.dtype)
+
+    @property
+    def nbytes(self) -> int:
+        return self.vectors.nbytes + (self.scales.nbytes if self.scales is not None else 0)
+
+    def __len__(self) -> int:
+        return len(self.vectors)
+
+    def score(self, query_embedding: np.ndarray) -> np.ndarray:
+        query = normalize_vector(query_embedding)
+
+        if self.vectors.dtype == np.float32 and self.scales is None:
+            return self.vectors @ query
+
+        scores = np.empty(len(self.vectors), dtype=np.float32)
+        for start in range(0, len(self.vectors), SCORE_BLOCK_SIZE):
+            end = start + SCORE_BLOCK_SIZE
+            scores[start:end] = self.vectors[start:end].astype(np.float32) @ query
+            if self.scales is not None:
+                scores[start:end] *= self.scales[start:end]
+        return scores
+
+    def score_many(self, query_embeddings: np.ndarray) -> np.ndarray:
+        queries = normalize_rows(query_embeddings)
+
+        if self.vectors.dtype == np.float32 and self.scales is None:
+            return queries @ self.vectors.T
+
+        scores = np.empty((len(queries), len(self.vectors)), dtype=np.float32)
+        for start in range(0, len(self.vectors), SCORE_BLOCK_SIZE):
+            end = start + SCORE_BLOCK_SIZE
+            scores[:, start:end] = queries @ self.vectors[start:end].astype(np.float32).T
+            if self.scales is not None:
+                scores[:, start:end] *= self.scales[start:end]
+        return scores
+
+    def score_rows(self, query_embedding: np.ndarray, rows: np.ndarray) -> np.ndarray:
+        query = normalize_vector(query_embedding)
+        scores = self.vectors[rows].astype(np.float32, copy=False) @ query
+        if self.scales is not None:
+            scores *= self.scales[rows]
+        return scores
+
+    def search(self, query_embedding: np.ndarray, limit: int) -> tuple[np.ndarray, np.ndarray]:
+        scores = self.score(query_embedding)
+        indices = top_k(scores, limit)
+        return indices, scores[indices]
@@ -1,8 +1,13 @@
 import argparse
+import time
 
 from search.data_processing import data_read
-from cli.search.chunked_semantic_search import ChunkedSemanticSearch
+from cli.search.chunked_semantic_search import ChunkedSemanticSearch, AGGREGATIONS
 from cli.search.chunking import basic_chunking, semantic_chunking
+from cli.search.ingestion import DOCUMENT_BATCH_SIZE, iter_documents
+from cli.search.ivf_index import DEFAULT_NPROBE
+from cli.search.pq_index import PQ_STORAGE
+from cli.search.vector_index import STORAGE_TYPES
 from cli.search.semantic_search import (
     SemanticSearch,
     verify_model,
@@ -11,6 +16,8 @@ from cli.search.semantic_search import (
     embed_query_text
 )
 
+storage_choices = (*STORAGE_TYPES, PQ_STORAGE)
+
 def main():
     parser = argparse.ArgumentParser(description="Semantic Search CLI")
     subparsers = parser.add_subparsers(dest="command", help="Available commands")
@@ -28,6 +35,8 @@ def main():
     embed_search_parser = subparsers.add_parser("search", help="Search the result based on semantic vectors")
     embed_search_parser.add_argument("query", help="Query for the embedding search")
     embed_search_parser.add_argument("--limit", type=int, nargs="?", default=5, help="The number of element in result data")
+    embed_search_parser.add_argument("--mmap", action="store_true", help="Memory-map the search index instead of reading it into memory")
+    embed_search_parser.add_argument("--storage", type=str, choices=storage_choices, default="float32", help="Storage type of the normalized embedding matrix")
 
     chunk_parser = subparsers.add_parser("chunk", help="Split the text into chunks")
     chunk_parser.add_argument("text", help="Specify text for the chunking")
@@ -42,9 +51,33 @@ def main():
     search_chunked_parser = subparsers.add_parser("search_chunked", help="Chunked semantic search")
     search_chunked_parser.add_argument("query", help="Specify query for the semantic search")
     search_chunked_parser.add_argument("--limit", type=int, nargs="?", default=5, help="The number of element in result data")
+    search_chunked_parser.add_argument("--aggregation", type=str, choices=AGGREGATIONS, default="max", help="How chunk scores are combined per movie")
+    search_chunked_parser.add_argument("--top-n", type=int, nargs="?", default=3, help="Number of best chunks averaged by the 'mean' aggregation")
+    search_chunked_parser.add_argument("--mmap", action="store_true", help="Memory-map the search index instead of reading it into memory")
+    search_chunked_parser.add_argument("--storage", type=str, choices=storage_choices, default="float32", help="Storage type of the normalized embedding matrix")
+    search_chunked_parser.add_argument("--ann", action="store_true", help="Search an IVF approximate index instead of scoring every chunk")
+    search_chunked_parser.add_argument("--nprobe", type=int, nargs="?", default=DEFAULT_NPROBE, help="Number of IVF lists probed per query")
+    search_chunked_parser.add_argument("--rescore", type=int, nargs="?", default=0, help="Re-score the movies of the best N chunks against the full-precision embeddings (use with --storage pq)")
+
+    ann_benchmark_parser = subparsers.add_parser("ann_benchmark", help="Compare IVF search with exact chunk search")
+    ann_benchmark_parser.add_argument("--limit", type=int, nargs="?", default=10, help="k for recall@k")
+    ann_benchmark_parser.add_argument("--queries", type=int, nargs="?", default=100, help="Number of movie titles used as queries")
+    ann_benchmark_parser.add_argument("--lists", type=int, help="Number of IVF lists (default: 4 * sqrt(chunks))")
+    ann_benchmark_parser.add_argument("--nprobe", type=int, nargs="+", default=[1, 2, 4, 8, 16, 32], help="nprobe values to compare")
+    ann_benchmark_parser.add_argument("--storage", type=str, choices=storage_choices, default="float32", help="Storage type of the normalized embedding matrix")
+
+    pq_benchmark_parser = subparsers.add_parser("pq_benchmark", help="Compare the product-quantized chunk store with float32 search")
+    pq_benchmark_parser.add_argument("--limit", type=int, nargs="?", default=10, help="k for recall@k")
+    pq_benchmark_parser.add_argument("--queries", type=int, nargs="?", default=100, help="Number of movie titles used as queries")
+    pq_benchmark_parser.add_argument("--rescore", type=int, nargs="+", default=[50, 200], help="Re-scoring depths to compare")
 
     subparsers.add_parser("embed_chunks", help="Prepare embeddings per chunk")
 
+    ingest_parser = subparsers.add_parser("ingest", help="Stream the movies file through chunking and encoding with resumable checkpoints")
+    ingest_parser.add_argument("--source", type=str, nargs="?", default="data/movies.json", help="Movies file, a JSON document with a 'movies' array or JSON Lines")
+    ingest_parser.add_argument("--batch-size", type=int, nargs="?", default=DOCUMENT_BATCH_SIZE, help="Number of movies encoded and checkpointed at once")
+    ingest_parser.add_argument("--target", type=str, choices=["documents", "chunks", "all"], default="all", help="Which embeddings to build")
+
     args = parser.parse_args()
 
     match args.command:
@@ -63,7 +96,7 @@ def main():
             limit = args.limit
             query = args.query
 
-            semantic_search = SemanticSearch()
+            semantic_search = SemanticSearch(mmap=args.mmap, storage=args.storage)
             data = data_read("data/movies.json")
             documents = data["movies"]
 
@@ -102,21 +135,113 @@ def main():
             embeddings = chunked_semantic_search.load_or_create_chunk_embeddings(documents)
             print(f"Generated {len(embeddings)} chunked embeddings")
 
+        case "ingest":
+            if args.target in ("documents", "all"):
+                semantic_search = SemanticSearch(mmap=True)
+                embeddings = semantic_search.ingest_embeddings(iter_documents(args.source), args.batch_size, source=args.source)
+                print(f"Ingested {len(embeddings)} document embeddings")
+
+            if args.target in ("chunks", "all"):
+                chunked_semantic_search = ChunkedSemanticSearch(mmap=True)
+                embeddings = chunked_semantic_search.ingest_chunk_embeddings(iter_documents(args.source), args.batch_size, source=args.source)
+                print(f"Ingested {len(embeddings)} chunk embeddings")
+
         case "search_chunked":
             query = args.query
             limit = args.limit
+            aggregation = args.aggregation
+            top_n = args.top_n
+            if top_n < 1:
+                parser.error("--top-n must be at least 1")
 
             data = data_read("data/movies.json")
             documents = data["movies"]
 
-            chunked_semantic_search = ChunkedSemanticSearch()
+            chunked_semantic_search = ChunkedSemanticSearch(mmap=args.mmap, storage=args.storage)
             chunked_semantic_search.load_or_create_chunk_embeddings(documents)
-            search_result = chunked_semantic_search.search_chunks(query, limit)
+            search_result = chunked_semantic_search.search_chunks(query, limit, aggregation, top_n, args.ann, args.nprobe, args.rescore)
 
             for index, element in enumerate(search_result):
+                metadata = element["metadata"]
                 print(f"\n{index}. {element['title']} (score: {element['score']:.4f})")
+                print(f"   Best chunk: {metadata['chunk_idx'] + 1}/{metadata['total_chunks']} (score: {metadata['chunk_score']:.4f})")
                 print(f"   {element['document']}...")
 
+        case "ann_benchmark":
+            limit = args.limit
+
+            data = data_read("data/movies.json")
+            documents = data["movies"]
+
+            chunked_semantic_search = ChunkedSemanticSearch(storage=args.storage)
+            chunked_semantic_search.load_or_create_chunk_embeddings(documents)
+
+            started = time.perf_counter()
+            ann_index = chunked_semantic_search.load_or_create_ann_index(args.lists)
+            print(f"IVF index: {ann_index.list_count} lists over {len(ann_index)} chunks ({time.perf_counter() - started:.2f}s)")
+
+            queries = [document["title"] for document in documents[:args.queries]]
+            query_embeddings = chunked_semantic_search.generate_embeddings(queries)
+
+            started = time.perf_counter()
+            exact_results = [
+                chunked_semantic_search.rank_chunk_scores(chunked_semantic_search.chunk_index.score(query_embedding), limit)
+                for query_embedding in query_embeddings
+            ]
+            exact_latency = (time.perf_counter() - started) / len(queries)
+            print(f"{'nprobe':>8} {'Recall@' + str(limit):>10} {'ms/query':>9}")
+            print(f"{'exact':>8} {1.0:>10.4f} {exact_latency * 1000:>9.2f}")
+
+            for nprobe in args.nprobe:
+                started = time.perf_counter()
+                ann_results = [
+                    chunked_semantic_search.rank_query(query_embedding, limit, ann=True, nprobe=nprobe)
+                    for query_embedding in query_embeddings
+                ]
+                latency = (time.perf_counter() - started) / len(queries)
+
+                recalls = [
+                    len({result["id"] for result in ann} & {result["id"] for result in exact}) / max(len(exact), 1)
+                    for ann, exact in zip(ann_results, exact_results)
+                ]
+                print(f"{nprobe:>8} {sum(recalls) / len(recalls):>10.4f} {latency * 1000:>9.2f}")
+
+        case "pq_benchmark":
+            limit = args.limit
+
+            data = data_read("data/movies.json")
+            documents = data["movies"]
+
+            exact_search = ChunkedSemanticSearch(mmap=True)
+            exact_search.load_or_create_chunk_embeddings(documents)
+
+            started = time.perf_counter()
+            pq_search = ChunkedSemanticSearch(mmap=True, storage=PQ_STORAGE)
+            pq_search.load_or_create_chunk_embeddings(documents)
+            print(f"PQ index: {pq_search.chunk_index.codes.shape[0]} sub-vectors over {len(pq_search.chunk_index)} chunks ({time.perf_counter() - started:.2f}s)")
+
+            queries = [document["title"] for document in documents[:args.queries]]
+            query_embeddings = exact_search.generate_embeddings(queries)
+
+            def run(search, **kwargs):
+                started = time.perf_counter()
+                results = [search.rank_query(query_embedding, limit, **kwargs) for query_embedding in query_embeddings]
+                return results, (time.perf_counter() - started) / len(queries)
+
+            exact_results, exact_latency = run(exact_search)
+            runs = [("float32", exact_search.chunk_index.nbytes, exact_results, exact_latency)]
+            runs.append(("pq", pq_search.chunk_index.nbytes, *run(pq_search)))
+            for rescore in args.rescore:
+                runs.append((f"pq+rescore {rescore}", pq_search.chunk_index.nbytes, *run(pq_search, rescore=rescore)))
+
+            print(f"{'Index':>18} {'Memory':>10} {'Recall@' + str(limit):>10} {'ms/query':>9}")
+            for name, nbytes, results, latency in runs:
+                recalls = [
+                    len({result["id"] for result in found} & {result["id"] for result in exact}) / max(len(exact), 1)
+                    for found, exact in zip(results, exact_results)
+                ]
+                print(f"{name:>18} {nbytes / 2 ** 20:>8.1f}MB {sum(recalls) / len(recalls):>10.4f} {latency * 1000:>9.2f}")
+
         case _:
             parser.print_help()
 